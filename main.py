@@ -1,26 +1,50 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
 import sys
 
-# Add src directory to path
-sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+from src.h5_reader import explore_h5_structure, get_basic_info, sample_data_preview
 
-from h5_reader import explore_h5_structure, get_basic_info, sample_data_preview
-from cog_converter import INSATCOGConverter
-from visualizer import INSATVisualizer
-from manipulations import INSATBandManipulator
+# The converter, visualizer and manipulator are imported inside the branches
+# that use them: rasterio, matplotlib and numba take seconds to load, which
+# the explore path should not pay for.
 
-def main():
+# Default INSAT sample file
+DEFAULT_H5_FILE = "data/sample.h5"
+
+def load_visualizer():
+    """
+    Import the visualizer on demand and return an instance, or None when its
+    dependencies (matplotlib) are unavailable
+    """
+    try:
+        from src.visualizer import INSATVisualizer
+    except ImportError as e:
+        print(f"❌ Visualization is unavailable: {e}")
+        return None
+    return INSATVisualizer()
+
+def load_manipulator():
+    """
+    Import the band manipulator on demand and return an instance, or None when
+    its dependencies (matplotlib, numba) are unavailable
     """
-    Main function to explore the INSAT sample data
+    try:
+        from src.manipulations import INSATBandManipulator
+    except ImportError as e:
+        print(f"❌ Manipulations are unavailable: {e}")
+        return None
+    return INSATBandManipulator()
+
+def run_interactive(file_path=DEFAULT_H5_FILE):
+    """
+    Prompt-driven walkthrough of exploration, conversion, visualization
+    and manipulation (the original demo menu)
     """
     print("INSAT COG Demo - Data Explorer")
     print("=" * 40)
     
-    # Path to sample file
-    file_path = "data/sample.h5"
-    
     if not os.path.exists(file_path):
         print(f"❌ Error: {file_path} not found!")
         print("Please make sure your sample.h5 file is in the data/ directory")
@@ -47,6 +71,8 @@ def main():
         # Demo COG conversion
         choice = input("\nWould you like to convert a sample band to COG? (y/n): ").lower().strip()
         if choice == 'y':
+            from src.cog_converter import INSATCOGConverter
+            
             print("\n" + "="*50)
             print("COG CONVERSION DEMO")
             print("="*50)
@@ -78,13 +104,13 @@ def main():
         
         # Visualization step
         vis_choice = input("\nWould you like to visualize the converted bands? (y/n): ").lower().strip()
-        if vis_choice == 'y':
+        visualizer = load_visualizer() if vis_choice == 'y' else None
+        if visualizer is not None:
             print("\n" + "="*50)
             print("VISUALIZATION DEMO")
             print("="*50)
             
-            visualizer = INSATVisualizer()
-            cogs = visualizer.get_available_cogs()
+            cogs = visualizer.cogs
             
             if not cogs:
                 print("No COG files found. Please convert bands to COG format first.")
@@ -176,13 +202,13 @@ def main():
         
         # Band manipulation step
         manip_choice = input("\nWould you like to perform band manipulations? (y/n): ").lower().strip()
-        if manip_choice == 'y':
+        manipulator = load_manipulator() if manip_choice == 'y' else None
+        if manipulator is not None:
             print("\n" + "="*50)
             print("BAND MANIPULATION DEMO")
             print("="*50)
             
-            manipulator = INSATBandManipulator()
-            cogs = manipulator.get_available_cogs()
+            cogs = manipulator.cogs
             
             if not cogs:
                 print("No COG files found. Please convert bands to COG format first.")
@@ -267,6 +293,7 @@ def main():
                         band_name = list(cogs.keys())[band_idx]
                         
                         # Get band dimensions
+                        import rasterio
                         with rasterio.open(cogs[band_name]) as src:
                             width = src.width
                             height = src.height
@@ -291,42 +318,7 @@ def main():
                 elif manip_option == "5":
                     # Run all manipulations
                     print("\nRunning all band manipulations...")
-                    if len(cogs) >= 2:
-                        bands = list(cogs.keys())[:2]
-                        
-                        # Band difference
-                        print(f"\nCalculating difference between {bands[0]} and {bands[1]}...")
-                        manipulator.band_difference(bands[0], bands[1])
-                        
-                        # Band ratio
-                        print(f"\nCalculating ratio of {bands[0]} to {bands[1]}...")
-                        manipulator.band_ratio(bands[0], bands[1])
-                        
-                        # Normalized difference
-                        print(f"\nCalculating normalized difference index...")
-                        manipulator.normalized_difference_index(bands[0], bands[1])
-                    else:
-                        print("Need at least 2 COG files for band arithmetic operations")
-                    
-                    # Extract region from first band
-                    if cogs:
-                        first_band = list(cogs.keys())[0]
-                        print(f"\nExtracting region from {first_band}...")
-                        
-                        with rasterio.open(cogs[first_band]) as src:
-                            width = src.width
-                            height = src.height
-                        
-                        # Extract central region (1/4 of the image)
-                        x_start = width // 4
-                        y_start = height // 4
-                        extract_width = width // 2
-                        extract_height = height // 2
-                        
-                        manipulator.extract_region(
-                            first_band, x_start, y_start, 
-                            extract_width, extract_height
-                        )
+                    run_all_manipulations(manipulator, cogs)
                 
                 else:
                     print("Invalid option")
@@ -352,5 +344,262 @@ def main():
         traceback.print_exc()
         print("Make sure the file is a valid HDF5 file")
 
+def explore_file(file_path):
+    """
+    Print the structure, dataset list and a data preview of one H5 file
+    """
+    if not os.path.exists(file_path):
+        print(f"❌ Error: {file_path} not found!")
+        return False
+    
+    explore_h5_structure(file_path)
+    get_basic_info(file_path)
+    sample_data_preview(file_path)
+    return True
+
+def cmd_explore(args):
+    """
+    explore: inspect one or more H5 files
+    """
+    for file_path in args.files:
+        explore_file(file_path)
+
+def cmd_convert(args):
+    """
+    convert: convert selected (or all) spectral bands of each H5 file to COG
+    """
+    from src.cog_converter import INSATCOGConverter
+    
+    for file_path in args.files:
+        if not os.path.exists(file_path):
+            print(f"❌ Error: {file_path} not found!")
+            continue
+        
+        converter = INSATCOGConverter(file_path, compression=args.compression)
+        
+        if args.all or not args.bands:
+            converter.convert_all_bands(max_workers=args.workers, force=args.force)
+        else:
+            for band_name in args.bands:
+                converter.convert_band_to_cog(band_name, force=args.force)
+
+def cmd_visualize(args):
+    """
+    visualize: render single bands, RGB composites, combinations or comparisons
+    """
+    visualizer = load_visualizer()
+    if visualizer is None:
+        return
+    
+    cogs = visualizer.cogs
+    
+    if not cogs:
+        print("No COG files found. Please convert bands to COG format first.")
+        return
+    
+    if args.all:
+        results = visualizer.create_all_visualizations(args.h5)
+        print(f"\n✅ Generated {len(results)} visualizations in {visualizer.output_directory}")
+        return
+    
+    for band_name in args.band or []:
+        visualizer.visualize_single_band(band_name)
+    if args.rgb:
+        visualizer.create_rgb_composite(*args.rgb)
+    for combo_name in args.combination or []:
+        visualizer.visualize_band_combination(combo_name)
+    for band_name in args.compare or []:
+        visualizer.compare_original_vs_cog(band_name, args.h5)
+    
+    print(f"\nVisualizations saved to: {visualizer.output_directory}")
+
+def cmd_manipulate(args):
+    """
+    manipulate: band arithmetic and region extraction on converted COGs
+    """
+    # Parse the region before the manipulator is loaded, so a typo fails fast
+    if args.region:
+        band_name = args.region[0]
+        try:
+            x_start, y_start, region_width, region_height = (int(v) for v in args.region[1:])
+        except ValueError:
+            args.parser.error("--region X, Y, WIDTH and HEIGHT must be integers")
+    
+    manipulator = load_manipulator()
+    if manipulator is None:
+        return
+    
+    cogs = manipulator.cogs
+    
+    if not cogs:
+        print("No COG files found. Please convert bands to COG format first.")
+        return
+    
+    if args.all:
+        run_all_manipulations(manipulator, cogs)
+    if args.difference:
+        manipulator.band_difference(*args.difference)
+    if args.ratio:
+        manipulator.band_ratio(*args.ratio)
+    if args.ndi:
+        manipulator.normalized_difference_index(*args.ndi)
+    if args.region:
+        if band_name not in cogs:
+            print(f"Band {band_name} not found as a COG file")
+            sys.exit(1)
+        
+        import rasterio
+        with rasterio.open(cogs[band_name]) as src:
+            width = src.width
+            height = src.height
+        
+        # Same bounds check as the interactive menu; rasterio would otherwise
+        # pad or resample a window that runs off the image
+        if (x_start < 0 or y_start < 0 or
+            region_width <= 0 or region_height <= 0 or
+            x_start + region_width > width or
+            y_start + region_height > height):
+            print(f"Invalid region coordinates for {band_name} ({width}x{height})")
+            sys.exit(1)
+        
+        manipulator.extract_region(band_name, x_start, y_start, region_width, region_height)
+    
+    print(f"\nManipulations saved to: {manipulator.output_directory}")
+
+def run_all_manipulations(manipulator, cogs):
+    """
+    Run difference, ratio and NDI on the first two bands, and extract the
+    central region of the first band
+    """
+    import rasterio
+    
+    if len(cogs) >= 2:
+        bands = list(cogs.keys())[:2]
+        
+        print(f"\nCalculating difference between {bands[0]} and {bands[1]}...")
+        manipulator.band_difference(bands[0], bands[1])
+        
+        print(f"\nCalculating ratio of {bands[0]} to {bands[1]}...")
+        manipulator.band_ratio(bands[0], bands[1])
+        
+        print(f"\nCalculating normalized difference index...")
+        manipulator.normalized_difference_index(bands[0], bands[1])
+    else:
+        print("Need at least 2 COG files for band arithmetic operations")
+    
+    first_band = list(cogs.keys())[0]
+    print(f"\nExtracting region from {first_band}...")
+    
+    with rasterio.open(cogs[first_band]) as src:
+        width = src.width
+        height = src.height
+    
+    # Extract central region (1/4 of the image)
+    manipulator.extract_region(first_band, width // 4, height // 4, width // 2, height // 2)
+
+def cmd_all(args):
+    """
+    all: explore, convert every band, then generate all visualizations and
+    manipulations
+    """
+    from src.cog_converter import INSATCOGConverter
+    
+    for file_path in args.files:
+        if not explore_file(file_path):
+            continue
+        converter = INSATCOGConverter(file_path, compression=args.compression)
+        converter.convert_all_bands(max_workers=args.workers, force=args.force)
+    
+    visualizer = load_visualizer()
+    if visualizer is not None:
+        visualizer.create_all_visualizations(args.files[-1])
+    
+    manipulator = load_manipulator()
+    if manipulator is not None:
+        cogs = manipulator.cogs
+        if cogs:
+            run_all_manipulations(manipulator, cogs)
+
+def build_parser():
+    """
+    Build the command line interface
+    """
+    parser = argparse.ArgumentParser(description="INSAT COG Demo - Data Explorer")
+    parser.add_argument("--interactive", action="store_true",
+                        help="run the prompt-driven demo menu")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    def add_files(subparser):
+        subparser.add_argument("files", nargs="*", default=[DEFAULT_H5_FILE],
+                               help=f"INSAT H5 file(s) (default: {DEFAULT_H5_FILE})")
+    
+    def add_conversion_options(subparser):
+        subparser.add_argument("--workers", type=int, default=None,
+                               help="parallel conversion processes (1 = serial)")
+        subparser.add_argument("--compression", default="deflate",
+                               choices=["deflate", "zstd", "lzw"],
+                               help="COG compression codec")
+        subparser.add_argument("--force", action="store_true",
+                               help="re-encode bands that already have an up-to-date COG")
+    
+    explore = subparsers.add_parser("explore", help="inspect H5 file structure")
+    add_files(explore)
+    explore.set_defaults(func=cmd_explore)
+    
+    convert = subparsers.add_parser("convert", help="convert bands to COG")
+    add_files(convert)
+    convert.add_argument("--bands", nargs="+", metavar="BAND",
+                         help="bands to convert (e.g. IMG_VIS IMG_TIR1)")
+    convert.add_argument("--all", action="store_true", help="convert every spectral band")
+    add_conversion_options(convert)
+    convert.set_defaults(func=cmd_convert)
+    
+    visualize = subparsers.add_parser("visualize", help="visualize converted COGs")
+    visualize.add_argument("--band", nargs="+", metavar="BAND",
+                           help="single band visualization(s)")
+    visualize.add_argument("--rgb", nargs=3, metavar=("RED", "GREEN", "BLUE"),
+                           help="RGB composite from three bands")
+    visualize.add_argument("--combination", nargs="+", metavar="NAME",
+                           help="predefined combination(s): natural_color, false_color, thermal")
+    visualize.add_argument("--compare", nargs="+", metavar="BAND",
+                           help="original H5 vs COG comparison for band(s)")
+    visualize.add_argument("--all", action="store_true", help="generate all visualizations")
+    visualize.add_argument("--h5", default=DEFAULT_H5_FILE,
+                           help="original H5 file used for comparisons")
+    visualize.set_defaults(func=cmd_visualize)
+    
+    manipulate = subparsers.add_parser("manipulate", help="band arithmetic on converted COGs")
+    manipulate.add_argument("--difference", nargs=2, metavar=("BAND1", "BAND2"),
+                            help="band1 - band2")
+    manipulate.add_argument("--ratio", nargs=2, metavar=("NUMERATOR", "DENOMINATOR"),
+                            help="numerator / denominator")
+    manipulate.add_argument("--ndi", nargs=2, metavar=("BAND1", "BAND2"),
+                            help="(band1 - band2) / (band1 + band2)")
+    manipulate.add_argument("--region", nargs=5, metavar=("BAND", "X", "Y", "WIDTH", "HEIGHT"),
+                            help="extract a pixel window from a band")
+    manipulate.add_argument("--all", action="store_true", help="run all manipulations")
+    manipulate.set_defaults(func=cmd_manipulate, parser=manipulate)
+    
+    run_all = subparsers.add_parser("all", help="run the full pipeline non-interactively")
+    add_files(run_all)
+    add_conversion_options(run_all)
+    run_all.set_defaults(func=cmd_all)
+    
+    return parser
+
+def main(argv=None):
+    """
+    Main entry point, e.g. `python main.py convert --all --workers 6 data/*.h5`
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    
+    if args.interactive:
+        run_interactive()
+    elif args.command is None:
+        parser.print_help()
+    else:
+        args.func(args)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
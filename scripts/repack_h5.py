@@ -0,0 +1,73 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+import h5py
+
+
+def band_layouts(file_path):
+    """
+    Build h5repack layout options that give every image band one chunk per
+    frame, matching how the converter and backend read a whole band at a time
+    """
+    layouts = []
+    with h5py.File(file_path, 'r') as f:
+        names = []
+        f.visit(names.append)
+        
+        for name in names:
+            obj = f[name]
+            # Image bands are (time, y, x) or (y, x); leave small 1-D
+            # coordinate and lookup datasets as they are
+            if not isinstance(obj, h5py.Dataset) or obj.ndim < 2:
+                continue
+            chunk = (1,) * (obj.ndim - 2) + obj.shape[-2:]
+            layouts.append(f"{name}:CHUNK={'x'.join(str(n) for n in chunk)}")
+    
+    return layouts
+
+
+def repack(source, target, compression="GZIP=1"):
+    """
+    Rewrite source into target with frame-sized chunks and shuffle + the
+    given h5repack filter, preserving attributes and dimension scales
+    """
+    h5repack = shutil.which("h5repack")
+    if h5repack is None:
+        print("❌ h5repack not found. Install the HDF5 command line tools (e.g. hdf5-tools).")
+        return False
+    
+    command = [h5repack]
+    for layout in band_layouts(source):
+        command += ["-l", layout]
+    command += ["-f", "SHUF", "-f", compression, source, target]
+    
+    print(f"Repacking {source} -> {target}")
+    subprocess.run(command, check=True)
+    
+    before = os.path.getsize(source) / (1024 * 1024)
+    after = os.path.getsize(target) / (1024 * 1024)
+    print(f"✅ Repacked: {before:.2f} MB -> {after:.2f} MB")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Repack an INSAT HDF5 file with one chunk per band frame"
+    )
+    parser.add_argument("source", nargs="?", default="data/Sample.h5",
+                        help="HDF5 file to repack (default: data/Sample.h5)")
+    parser.add_argument("target", nargs="?",
+                        help="Output file (default: <source>_opt.h5 next to the source)")
+    parser.add_argument("--compression", default="GZIP=1",
+                        help="h5repack filter applied after shuffle (default: GZIP=1)")
+    args = parser.parse_args(argv)
+    
+    target = args.target or f"{os.path.splitext(args.source)[0]}_opt.h5"
+    return 0 if repack(args.source, target, args.compression) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
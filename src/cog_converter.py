@@ -3,14 +3,114 @@ import numpy as np
 import rasterio
 from rasterio.transform import from_bounds
 from rasterio.crs import CRS
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.windows import Window
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as copy_dataset
+from rasterio.enums import Resampling
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from itertools import repeat
+from contextlib import nullcontext
 import os
 
+from .file_utils import atomic_output, output_lock
+
+# HDF5 raw-data chunk cache used when reading bands. The h5py default (1 MiB)
+# is smaller than a single INSAT image chunk, which forces HDF5 to decompress
+# the same chunk again on every partial read.
+H5_CHUNK_CACHE_BYTES = 256 * 1024 * 1024
+H5_CHUNK_CACHE_SLOTS = 100003
+
+# Per-band chunk cache sizing: hold at least 64 chunks (or 64 MiB), but never
+# more than 512 MiB so pathological chunk shapes cannot exhaust RAM
+H5_CHUNK_CACHE_MIN_BYTES = 64 * 1024 * 1024
+H5_CHUNK_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Tile size of the output COGs; bands are streamed from HDF5 in windows of
+# this size instead of being materialized as one full-band array
+COG_BLOCK_SIZE = 512
+
+# Overview (pyramid) decimation factors built for every COG
+OVERVIEW_FACTORS = [2, 4, 8, 16]
+
+# GDAL configuration shared by every conversion in a batch: a 512 MB block
+# cache, threaded compression and internal (not .msk sidecar) masks
+GDAL_BATCH_OPTIONS = {
+    'GDAL_CACHEMAX': 512,
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'CPL_VSIL_USE_TEMP_FILE_FOR_RANDOM_WRITE': 'NO',
+    'GDAL_TIFF_INTERNAL_MASK': 'YES'
+}
+
+# GDAL environment held open for the lifetime of a conversion worker process
+_worker_env = None
+
+
+def _iter_windows(width, height, size=COG_BLOCK_SIZE):
+    """
+    Yield size x size windows (clipped at the edges) covering a raster
+    """
+    for row_off in range(0, height, size):
+        for col_off in range(0, width, size):
+            yield Window(col_off, row_off,
+                         min(size, width - col_off), min(size, height - row_off))
+
+
+def _next_prime(n):
+    """
+    Return the smallest prime >= n (used for HDF5 chunk cache slot counts)
+    """
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def _pool_context():
+    """
+    Start pool workers from a forkserver where available, so the heavy
+    imports are paid once by the server instead of by every worker
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return None
+
+
+def _init_conversion_worker():
+    """
+    Process pool initializer: enter one GDAL environment per worker so all
+    bands converted by that worker share a warm block cache
+    """
+    global _worker_env
+    _worker_env = rasterio.Env(**GDAL_BATCH_OPTIONS)
+    _worker_env.__enter__()
+
+
+def _convert_band_worker(converter, band_name, force):
+    """
+    Process pool entry point: convert one band with a pickled converter
+    """
+    return converter.convert_band_to_cog(band_name, force=force)
+
+
 class INSATCOGConverter:
-    def __init__(self, h5_file_path):
+    def __init__(self, h5_file_path, compression='deflate'):
+        """
+        Args:
+            h5_file_path: Path to the INSAT HDF5 file
+            compression: COG compression codec ('deflate', 'zstd' or 'lzw').
+                'zstd' needs a GDAL build with ZSTD support.
+        """
         self.h5_file_path = h5_file_path
+        self.compression = compression.upper()
         self.output_dir = "../../output/converted_cogs"
         
+        # Projection info is identical for every band, so it is read once
+        self._proj_info = None
+        
+        # Bands present in the file, filled in by the first get_band_info call
+        self._available_bands = None
+        
         # Ensure output directory exists
         os.makedirs(self.output_dir, exist_ok=True)
         
@@ -24,130 +124,279 @@ class INSATCOGConverter:
             'IMG_TIR2': {'name': 'Thermal IR2', 'wavelength': '11.966μm'}
         }
     
-    def get_projection_info(self):
+    def _open(self, band_name=None):
+        """
+        Open the HDF5 file read-only with an enlarged chunk cache
+        
+        When band_name is given the cache is sized from that band's chunk
+        shape (64 chunks, at least 64 MiB, capped at 512 MiB) so windows that
+        straddle chunk boundaries never re-decompress a chunk.
+        """
+        rdcc_nbytes = H5_CHUNK_CACHE_BYTES
+        rdcc_nslots = H5_CHUNK_CACHE_SLOTS
+        
+        if band_name is not None:
+            with h5py.File(self.h5_file_path, 'r') as f:
+                dataset = f.get(band_name)
+                chunks = dataset.chunks if isinstance(dataset, h5py.Dataset) else None
+                itemsize = dataset.dtype.itemsize if chunks else 0
+            
+            if chunks:
+                chunk_bytes = int(np.prod(chunks)) * itemsize
+                rdcc_nbytes = min(max(64 * chunk_bytes, H5_CHUNK_CACHE_MIN_BYTES),
+                                  H5_CHUNK_CACHE_MAX_BYTES)
+                rdcc_nslots = _next_prime(10 * (rdcc_nbytes // chunk_bytes))
+        
+        return h5py.File(self.h5_file_path, 'r',
+                         rdcc_nbytes=rdcc_nbytes,
+                         rdcc_nslots=rdcc_nslots,
+                         rdcc_w0=0.75)
+    
+    def get_projection_info(self, h5_handle=None):
         """
         Extract projection and coordinate information from the HDF5 file
+        
+        The result is cached on the converter after the first call. An already
+        open h5py.File can be passed as h5_handle to avoid reopening the file.
         """
-        with h5py.File(self.h5_file_path, 'r') as f:
-            # Get coordinate arrays
-            x_coords = f['X'][:]
-            y_coords = f['Y'][:]
+        if self._proj_info is not None:
+            return self._proj_info
+        
+        with nullcontext(h5_handle) if h5_handle is not None else self._open() as f:
+            # Coordinate datasets; only their end points and lengths are needed
+            x_ds = f['X']
+            y_ds = f['Y']
+            nx = x_ds.shape[0]
+            ny = y_ds.shape[0]
             
             # Get projection information
             proj_info = f['Projection_Information']
             
-            # Extract key projection parameters
-            proj_attrs = dict(proj_info.attrs)
+            # Extract the projection origin (a single attribute read)
+            lon0 = float(proj_info.attrs['longitude_of_projection_origin'][0])
             
             # Calculate bounds
-            x_min, x_max = float(x_coords[0]), float(x_coords[-1])
-            y_min, y_max = float(y_coords[-1]), float(y_coords[0])  # Y is often flipped
+            x_min, x_max = float(x_ds[0]), float(x_ds[-1])
+            y_min, y_max = float(y_ds[-1]), float(y_ds[0])  # Y is often flipped
             
             # Calculate pixel size
-            x_res = (x_max - x_min) / len(x_coords)
-            y_res = (y_max - y_min) / len(y_coords)
+            x_res = (x_max - x_min) / nx
+            y_res = (y_max - y_min) / ny
             
             # Create affine transform
-            transform = from_bounds(x_min, y_min, x_max, y_max, 
-                                  len(x_coords), len(y_coords))
+            transform = from_bounds(x_min, y_min, x_max, y_max, nx, ny)
             
             # Define CRS (Mercator projection)
-            crs = CRS.from_proj4(f"+proj=merc +lon_0={proj_attrs['longitude_of_projection_origin'][0]} "
+            crs = CRS.from_proj4(f"+proj=merc +lon_0={lon0} "
                                f"+datum=WGS84 +units=m +no_defs")
             
-            return {
+            self._proj_info = {
                 'transform': transform,
                 'crs': crs,
-                'width': len(x_coords),
-                'height': len(y_coords),
+                'width': nx,
+                'height': ny,
                 'bounds': (x_min, y_min, x_max, y_max)
             }
+            return self._proj_info
+    
+    def _output_dtype(self, band_data, dtype_override=None):
+        """
+        Pick the narrowest lossless storage dtype for a band
+        
+        Integer bands wider than 16 bits are stored as uint16 when their
+        'valid_range' attribute fits in 0..65535. Any other narrowing (e.g.
+        float32 -> uint16) must be requested explicitly via dtype_override and
+        is only lossless if the data actually fits the target type.
+        """
+        if dtype_override is not None:
+            return np.dtype(dtype_override)
+        
+        dtype = band_data.dtype
+        valid_range = band_data.attrs.get('valid_range')
+        if (np.issubdtype(dtype, np.integer) and dtype.itemsize > 2
+                and valid_range is not None and len(valid_range) == 2
+                and valid_range[0] >= 0 and valid_range[1] <= 65535):
+            return np.dtype(np.uint16)
+        
+        return dtype
     
-    def convert_band_to_cog(self, band_name):
+    def cog_path(self, band_name):
+        """
+        Path of the COG written for band_name
+        """
+        return os.path.join(self.output_dir, f"{band_name}_cog.tif")
+    
+    def is_converted(self, band_name):
+        """
+        True when band_name has a COG newer than the source HDF5 file
+        """
+        output_path = self.cog_path(band_name)
+        return (os.path.exists(output_path)
+                and os.path.getmtime(output_path) > os.path.getmtime(self.h5_file_path))
+    
+    def convert_band_to_cog(self, band_name, dtype_override=None, force=False, h5_handle=None):
         """
         Convert a single spectral band to Cloud Optimized GeoTIFF
+        
+        Args:
+            band_name: Name of the HDF5 band dataset (e.g. 'IMG_VIS')
+            dtype_override: Storage dtype for the COG. Defaults to the band's
+                own dtype, narrowed to uint16 when its valid_range allows.
+            force: Re-encode even if an up-to-date COG already exists
+            h5_handle: Open h5py.File to read from. When None the file is
+                opened (and closed) for this band only.
         """
-        print(f"Converting {band_name} to COG...")
+        # Output file path
+        output_path = self.cog_path(band_name)
         
-        with h5py.File(self.h5_file_path, 'r') as f:
-            if band_name not in f:
-                print(f"Band {band_name} not found in file!")
-                return None
+        # Concurrent conversions of one band wait here, then find it converted
+        with output_lock(output_path):
+            # Skip bands whose COG is newer than the source file
+            if not force and self.is_converted(band_name):
+                print(f"✅ {band_name} already converted -> {output_path}")
+                return output_path
             
-            # Read the band data
-            band_data = f[band_name]
+            print(f"Converting {band_name} to COG...")
             
-            # Handle 3D data (time, y, x) by taking the first time slice
-            if len(band_data.shape) == 3:
-                data_array = band_data[0, :, :]
-            else:
-                data_array = band_data[:, :]
-            
-            # Get projection info
-            proj_info = self.get_projection_info()
-            
-            # Output file path
-            output_path = os.path.join(self.output_dir, f"{band_name}_cog.tif")
-            
-            # COG creation profile
-            cog_profile = {
-                'driver': 'GTiff',
-                'dtype': data_array.dtype,
-                'width': proj_info['width'],
-                'height': proj_info['height'],
-                'count': 1,
-                'crs': proj_info['crs'],
-                'transform': proj_info['transform'],
-                'tiled': True,
-                'blockxsize': 512,
-                'blockysize': 512,
-                'compress': 'lzw',
-                'interleave': 'pixel',
-                'BIGTIFF': 'IF_SAFER'
-            }
-            
-            # Write the COG
-            with rasterio.open(output_path, 'w', **cog_profile) as dst:
-                dst.write(data_array, 1)
+            with nullcontext(h5_handle) if h5_handle is not None else self._open(band_name) as f:
+                if band_name not in f:
+                    print(f"Band {band_name} not found in file!")
+                    return None
                 
-                # Add band metadata
-                dst.set_band_description(1, f"{self.spectral_bands.get(band_name, {}).get('name', band_name)}")
+                # Band dataset; slabs are read lazily per output window below
+                band_data = f[band_name]
                 
-                # Add tags
-                dst.update_tags(
-                    BAND_NAME=band_name,
-                    WAVELENGTH=self.spectral_bands.get(band_name, {}).get('wavelength', 'Unknown'),
-                    SOURCE_FILE=os.path.basename(self.h5_file_path),
-                    CREATED_BY='INSAT COG Converter'
-                )
-            
-            # Add overviews for efficient zoom
-            self._add_overviews(output_path)
-            
-            print(f"✅ Converted {band_name} -> {output_path}")
-            return output_path
-    
-    def _add_overviews(self, file_path):
-        """
-        Add overviews (pyramids) to the GeoTIFF for efficient zooming
-        """
-        with rasterio.open(file_path, 'r+') as dst:
-            # Calculate overview factors (2, 4, 8, 16)
-            factors = [2, 4, 8, 16]
-            dst.build_overviews(factors, Resampling.average)
-            dst.update_tags(ns='rio_overview', resampling='average')
+                # Get projection info
+                proj_info = self.get_projection_info(f)
+                
+                # Narrowest lossless container for the band values
+                out_dtype = self._output_dtype(band_data, dtype_override)
+                
+                # Fill value marking invalid pixels, if the band declares one
+                fill_value = band_data.attrs.get('_FillValue')
+                if fill_value is not None:
+                    fill_value = np.asarray(fill_value).ravel()[0]
+                
+                # Staging profile: an uncompressed tiled GTiff held in /vsimem/
+                staging_profile = {
+                    'driver': 'GTiff',
+                    'dtype': out_dtype,
+                    'width': proj_info['width'],
+                    'height': proj_info['height'],
+                    'count': 1,
+                    'crs': proj_info['crs'],
+                    'transform': proj_info['transform'],
+                    'tiled': True,
+                    'blockxsize': COG_BLOCK_SIZE,
+                    'blockysize': COG_BLOCK_SIZE
+                }
+                if fill_value is not None and np.asarray(fill_value, dtype=out_dtype) == fill_value:
+                    staging_profile['nodata'] = fill_value
+                
+                # COG creation options for the final copy. The COG driver reuses
+                # the overviews built in memory and writes the file in one pass.
+                cog_options = {
+                    'BLOCKSIZE': COG_BLOCK_SIZE,
+                    'COMPRESS': self.compression,
+                    'OVERVIEWS': 'FORCE_USE_EXISTING',
+                    'NUM_THREADS': 'ALL_CPUS'
+                }
+                
+                # Horizontal differencing (integer) or floating point prediction
+                # lets DEFLATE/ZSTD compress smooth imagery much better than LZW
+                if self.compression in ('DEFLATE', 'ZSTD'):
+                    is_float = np.issubdtype(out_dtype, np.floating)
+                    cog_options['PREDICTOR'] = 'FLOATING_POINT' if is_float else 'STANDARD'
+                if self.compression == 'ZSTD':
+                    cog_options['LEVEL'] = 9
+                
+                # Build the raster and its overview pyramid in memory, then emit
+                # the COG with a single disk write and no re-reads
+                with MemoryFile() as memfile:
+                    with memfile.open(**staging_profile) as mem:
+                        # Stream one tile-sized slab at a time; HDF5 only
+                        # decompresses the chunks each slab touches
+                        for window in _iter_windows(proj_info['width'], proj_info['height']):
+                            rows = slice(window.row_off, window.row_off + window.height)
+                            cols = slice(window.col_off, window.col_off + window.width)
+                            
+                            # Handle 3D data (time, y, x) by taking the first time slice
+                            if len(band_data.shape) == 3:
+                                slab = band_data[0, rows, cols]
+                            else:
+                                slab = band_data[rows, cols]
+                            
+                            mem.write(np.asarray(slab, dtype=out_dtype), 1, window=window)
+                            
+                            # Internal 1-bit validity mask; mostly-valid tiles
+                            # compress to a few bytes and let clients skip
+                            # empty regions without reading pixel data
+                            if fill_value is not None:
+                                mask = np.where(slab != fill_value, 255, 0).astype(np.uint8)
+                                mem.write_mask(mask, window=window)
+                        
+                        # Add band metadata
+                        mem.set_band_description(1, f"{self.spectral_bands.get(band_name, {}).get('name', band_name)}")
+                        
+                        # Add tags
+                        mem.update_tags(
+                            BAND_NAME=band_name,
+                            WAVELENGTH=self.spectral_bands.get(band_name, {}).get('wavelength', 'Unknown'),
+                            SOURCE_FILE=os.path.basename(self.h5_file_path),
+                            CREATED_BY='INSAT COG Converter'
+                        )
+                        
+                        # Add overviews (pyramids) for efficient zooming. GDAL
+                        # computes the average kernel on its thread pool, and the
+                        # overview tiles share the main 512px tiling.
+                        with rasterio.Env(GDAL_NUM_THREADS='ALL_CPUS',
+                                          GDAL_TIFF_OVR_BLOCKSIZE=COG_BLOCK_SIZE):
+                            mem.build_overviews(OVERVIEW_FACTORS, Resampling.average)
+                        mem.update_tags(ns='rio_overview', resampling='average')
+                        
+                        # Written under a temporary name and moved into place once
+                        # complete: a truncated COG would be newer than the HDF5
+                        # file and pass is_converted forever
+                        with atomic_output(output_path) as tmp_path:
+                            copy_dataset(mem, tmp_path, driver='COG', **cog_options)
+                
+                print(f"✅ Converted {band_name} -> {output_path}")
+                return output_path
     
-    def convert_all_bands(self):
+    def convert_all_bands(self, max_workers=None, force=False):
         """
         Convert all main spectral bands to COG format
+        
+        Each band is an independent HDF5 read + GeoTIFF write, so the bands
+        are converted in parallel worker processes. Pass max_workers=1 (or set
+        INSAT_COG_SERIAL=1) to convert serially, e.g. for debugging. Bands with
+        an up-to-date COG are skipped unless force=True.
         """
         print("Starting COG conversion for all spectral bands...")
         print("=" * 50)
         
-        converted_files = {}
+        band_names = list(self.spectral_bands.keys())
+        if max_workers is None:
+            max_workers = min(len(band_names), os.cpu_count() or 1)
+        if os.environ.get("INSAT_COG_SERIAL") == "1":
+            max_workers = 1
+        
+        if max_workers > 1:
+            # Populate the projection cache so the pickled workers inherit it
+            self.get_projection_info()
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=_pool_context(),
+                                     initializer=_init_conversion_worker) as executor:
+                results = list(executor.map(_convert_band_worker, repeat(self), band_names,
+                                            repeat(force)))
+        else:
+            # One HDF5 open (superblock parse + chunk cache) for all bands
+            with rasterio.Env(**GDAL_BATCH_OPTIONS), self._open() as f:
+                results = [self.convert_band_to_cog(band_name, force=force, h5_handle=f)
+                           for band_name in band_names]
         
-        for band_name in self.spectral_bands.keys():
-            output_path = self.convert_band_to_cog(band_name)
+        converted_files = {}
+        for band_name, output_path in zip(band_names, results):
             if output_path:
                 converted_files[band_name] = output_path
         
@@ -156,11 +405,54 @@ class INSATCOGConverter:
         
         return converted_files
     
+    def convert_bands_to_cog(self, band_names, max_workers=None, force=False, h5_handle=None):
+        """
+        Convert several bands in one pass over a single open HDF5 file
+        
+        The bands share one file handle (one metadata parse, one chunk cache)
+        and are converted on a thread pool: HDF5 reads are serialized by h5py,
+        but GDAL's GeoTIFF encoding releases the GIL and runs concurrently.
+        
+        Args:
+            band_names: Band dataset names to convert
+            max_workers: Number of threads (default: one per band, up to the CPU count)
+            force: Re-encode even if an up-to-date COG already exists
+            h5_handle: Open h5py.File to read from instead of opening the file
+        
+        Returns:
+            Dict mapping each successfully converted band to its COG path
+        """
+        band_names = list(band_names)
+        if not band_names:
+            return {}
+        if max_workers is None:
+            max_workers = min(len(band_names), os.cpu_count() or 1)
+        
+        def convert(band_name, f):
+            # GDAL configuration is thread-local, so each worker enters its own Env
+            with rasterio.Env(**GDAL_BATCH_OPTIONS):
+                return self.convert_band_to_cog(band_name, force=force, h5_handle=f)
+        
+        with nullcontext(h5_handle) if h5_handle is not None else self._open() as f:
+            # Populate the projection cache once instead of racing on it
+            self.get_projection_info(f)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(convert, band_names, repeat(f)))
+        
+        return {band_name: output_path
+                for band_name, output_path in zip(band_names, results) if output_path}
+    
     def get_band_info(self):
         """
         Get information about available bands
+        
+        The file is only traversed on the first call; later calls return the
+        cached result.
         """
-        with h5py.File(self.h5_file_path, 'r') as f:
+        if self._available_bands is not None:
+            return self._available_bands
+        
+        with self._open() as f:
             band_info = {}
             for band_name in self.spectral_bands.keys():
                 if band_name in f:
@@ -171,6 +463,7 @@ class INSATCOGConverter:
                         'description': self.spectral_bands[band_name]['name'],
                         'wavelength': self.spectral_bands[band_name]['wavelength']
                     }
+            self._available_bands = band_info
             return band_info
 
 def demo_conversion():
@@ -200,4 +493,6 @@ def demo_conversion():
     converter.convert_band_to_cog(first_band)
 
 if __name__ == "__main__":
+    # The package-relative imports above need src imported as a package, so
+    # run the demo from the repository root: python -m src.cog_converter
     demo_conversion()
\ No newline at end of file
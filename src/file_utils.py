@@ -0,0 +1,45 @@
+import os
+import threading
+from contextlib import contextmanager, suppress
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Yield a temporary path next to path, moved over path with os.replace
+    only once the block completes
+    
+    Readers and the mtime freshness checks never see a partially written
+    file: an interrupted write leaves no file at path (the temporary one is
+    removed) rather than a truncated one that looks up to date. The name
+    keeps path's extension so writers that infer the format still work.
+    """
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    tmp_path = os.path.join(directory, f".{stem}.{os.getpid()}.{threading.get_ident()}{ext}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+# One lock per output path, created on first use
+_output_locks = {}
+_output_locks_guard = threading.Lock()
+
+
+def output_lock(path):
+    """
+    Process-wide lock serializing the writers of one output path
+    
+    Concurrent requests for the same band or operation wait for the first
+    writer instead of encoding the same file side by side, then find its
+    result up to date. Writers in other processes are kept apart by
+    atomic_output.
+    """
+    key = os.path.realpath(path)
+    with _output_locks_guard:
+        return _output_locks.setdefault(key, threading.Lock())
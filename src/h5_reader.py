@@ -2,6 +2,22 @@ import h5py
 import numpy as np
 import os
 
+# Raw data chunk cache for read-only access; INSAT band chunks are several
+# MB each, so h5py's 1 MiB default would decompress the same chunk repeatedly
+H5_READ_CACHE_BYTES = 128 * 1024 * 1024
+H5_READ_CACHE_SLOTS = 1_000_003
+
+def open_h5(file_path):
+    """
+    Open an HDF5 file read-only with a chunk cache sized for INSAT bands
+    """
+    return h5py.File(
+        file_path, 'r',
+        rdcc_nbytes=H5_READ_CACHE_BYTES,
+        rdcc_nslots=H5_READ_CACHE_SLOTS,
+        rdcc_w0=0.75
+    )
+
 def explore_h5_structure(file_path):
     """
     Explore and print the structure of an HDF5 file
@@ -9,11 +25,16 @@ def explore_h5_structure(file_path):
     print(f"Exploring: {file_path}")
     print("=" * 50)
     
-    with h5py.File(file_path, 'r') as f:
+    with open_h5(file_path) as f:
         print(f"File keys: {list(f.keys())}")
         print("\nDetailed structure:")
         
-        def print_structure(name, obj):
+        # Collect link names in one C-level traversal, then inspect each
+        names = []
+        f.visit(names.append)
+        
+        for name in names:
+            obj = f[name]
             indent = "  " * name.count('/')
             if isinstance(obj, h5py.Dataset):
                 print(f"{indent}{name} (Dataset): shape={obj.shape}, dtype={obj.dtype}")
@@ -27,8 +48,6 @@ def explore_h5_structure(file_path):
                 if obj.attrs:
                     for attr_name, attr_value in obj.attrs.items():
                         print(f"{indent}  - {attr_name}: {attr_value}")
-        
-        f.visititems(print_structure)
 
 def get_basic_info(file_path):
     """
@@ -37,27 +56,54 @@ def get_basic_info(file_path):
     file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
     print(f"\nFile size: {file_size:.2f} MB")
     
-    with h5py.File(file_path, 'r') as f:
+    with open_h5(file_path) as f:
         # Try to find datasets that look like image bands
         datasets = []
         
-        def find_datasets(name, obj):
+        names = []
+        f.visit(names.append)
+        
+        for name in names:
+            obj = f[name]
             if isinstance(obj, h5py.Dataset):
                 datasets.append((name, obj.shape, obj.dtype))
         
-        f.visititems(find_datasets)
-        
         print(f"\nFound {len(datasets)} datasets:")
         for name, shape, dtype in datasets:
             print(f"  {name}: {shape} ({dtype})")
         
         return datasets
 
-def sample_data_preview(file_path, dataset_name="IMG_VIS", sample_size=5):
+def _chunked_range(data, time_index=None):
+    """
+    Exact min/max of data, or of data[time_index] for a (time, y, x)
+    dataset, folded one HDF5 chunk at a time
+    
+    iter_chunks only gets explicit slice(start, stop) bounds: h5py before
+    3.12 compares each slice's start with 0, which fails for integer
+    indices and open slices. The time index is kept as a length-1 slice,
+    which leaves the min/max unchanged.
+    """
+    selection = tuple(slice(0, n) for n in data.shape)
+    if time_index is not None:
+        selection = (slice(time_index, time_index + 1),) + selection[1:]
+    slices = data.iter_chunks(selection) if data.chunks else [selection]
+    mn, mx = np.inf, -np.inf
+    for sl in slices:
+        block = data[sl]
+        mn = min(mn, block.min())
+        mx = max(mx, block.max())
+    return mn, mx
+
+def sample_data_preview(file_path, dataset_name="IMG_VIS", sample_size=5, verbose_stats=False):
     """
     Show a small sample of data from a dataset
+    
+    Args:
+        verbose_stats: Compute the exact data range chunk by chunk instead
+            of estimating it from a strided sample
     """
-    with h5py.File(file_path, 'r') as f:
+    with open_h5(file_path) as f:
         # Default to visible band for preview
         if dataset_name in f:
             data = f[dataset_name]
@@ -67,16 +113,24 @@ def sample_data_preview(file_path, dataset_name="IMG_VIS", sample_size=5):
             # Show a small sample
             if len(data.shape) == 3:
                 sample = data[0, :sample_size, :sample_size]  # First band
-                data_array = data[0, :, :]  # Get 2D array for stats
+                strided = np.s_[0, ::16, ::16]
             elif len(data.shape) == 2:
                 sample = data[:sample_size, :sample_size]
-                data_array = data[:, :]
+                strided = np.s_[::16, ::16]
             else:
-                sample = data.flat[:sample_size]
-                data_array = data[:]
+                sample = data[:sample_size]
+                strided = np.s_[::16]
             
             print(f"Sample values:\n{sample}")
-            print(f"Data range: {np.min(data_array)} to {np.max(data_array)}")
+            
+            # The full band is never materialized: either fold the range
+            # over HDF5 chunks or estimate it from every 16th row/column
+            if verbose_stats:
+                mn, mx = _chunked_range(data, 0 if len(data.shape) == 3 else None)
+                print(f"Data range: {mn} to {mx}")
+            else:
+                data_array = data[strided]
+                print(f"Data range (sampled): {np.min(data_array)} to {np.max(data_array)}")
             
             # Show some key bands info
             bands_info = {
@@ -1,10 +1,15 @@
-
 import os
+import threading
+from functools import cached_property
 import numpy as np
 import rasterio
+from rasterio.enums import MaskFlags
 from rasterio.windows import Window
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use('Agg')
+
+from .file_utils import atomic_output, output_lock
+from .kernels import band_difference_kernel, band_ratio_kernel, ndi_kernel, fast_stretch_bounds
 
 
 class INSATBandManipulator:
@@ -17,32 +22,71 @@ class INSATBandManipulator:
         
         # Create output directory if it doesn't exist
         os.makedirs(output_directory, exist_ok=True)
+        
+        # Reusable figure for rendering, created on first use, and the lock
+        # that serializes its use when the instance is shared across threads
+        self._fig = None
+        self._render_lock = threading.RLock()
     
-    def get_available_cogs(self):
+    def _figure(self, figsize):
         """
-        Get a list of available COG files in the directory
+        Return this instance's reusable figure, cleared and resized
+        
+        Creating a pyplot figure per plot pays for figure setup and
+        teardown every time; one Agg Figure per instance is reused instead.
+        """
+        if self._fig is None:
+            from matplotlib.figure import Figure
+            self._fig = Figure()
+        self._fig.clear()
+        self._fig.set_size_inches(figsize)
+        return self._fig
+    
+    @cached_property
+    def cogs(self):
+        """
+        Mapping of band name to COG file path, scanned once and cached
+        
+        Call invalidate_cogs() after new COGs are written to the directory.
         """
         cog_files = {}
         if os.path.exists(self.cog_directory):
-            for filename in os.listdir(self.cog_directory):
-                if filename.endswith("_cog.tif"):
-                    band_name = filename.split("_cog.tif")[0]
-                    cog_files[band_name] = os.path.join(self.cog_directory, filename)
+            with os.scandir(self.cog_directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith("_cog.tif"):
+                        band_name = entry.name[:-len("_cog.tif")]
+                        cog_files[band_name] = entry.path
         
         return cog_files
     
-    def load_band_data(self, band_name):
+    def invalidate_cogs(self):
+        """
+        Drop the cached COG listing so the next access rescans the directory
+        """
+        self.__dict__.pop('cogs', None)
+    
+    def get_available_cogs(self):
+        """
+        Get a list of available COG files in the directory
+        """
+        return self.cogs
+    
+    def load_band_data(self, band_name, dtype=None):
         """
         Load data from a specific band
+        
+        Args:
+            band_name: Name of the band to load
+            dtype: Read the band directly as this dtype (default: native dtype)
         """
-        cogs = self.get_available_cogs()
+        cogs = self.cogs
         
         if band_name not in cogs:
             print(f"Band {band_name} not found as a COG file")
             return None, None
         
         with rasterio.open(cogs[band_name]) as src:
-            band_data = src.read(1)
+            band_data = src.read(1, out_dtype=dtype)
             profile = src.profile.copy()
             
         return band_data, profile
@@ -55,11 +99,137 @@ class INSATBandManipulator:
         max_val = np.max(data)
         
         if max_val > min_val:
-            return (data - min_val) / (max_val - min_val)
+            # One allocation for the result, then scale it in place
+            normalized = np.subtract(data, np.float32(min_val))
+            np.multiply(normalized, np.float32(1.0 / (max_val - min_val)), out=normalized)
+            return normalized
         else:
-            return data * 0
+            return np.zeros_like(data)
     
-    def band_difference(self, band1, band2, output_name=None):
+    def _output_profile(self, profile):
+        """
+        Profile for float32 results: 512x512 tiles with DEFLATE and the
+        floating point predictor, which suits smooth difference/ratio fields
+        
+        The input's nodata value is dropped: a fill of 0 or 1023 is a valid
+        difference or ratio, so invalid pixels are carried in a mask instead.
+        """
+        profile = profile.copy()
+        profile.update(
+            driver='GTiff',
+            dtype=rasterio.float32,
+            nodata=None,
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            compress='deflate',
+            predictor=3,
+            zlevel=1,
+            BIGTIFF='IF_SAFER',
+            num_threads='all_cpus'
+        )
+        return profile
+    
+    def _is_fresh(self, output_path, vis_path, *bands):
+        """
+        True when an operation's output and visualization both exist and are
+        newer than every input band's COG
+        """
+        cogs = self.cogs
+        if not all(band in cogs for band in bands):
+            return False
+        if not (os.path.exists(output_path) and os.path.exists(vis_path)):
+            return False
+        oldest = min(os.path.getmtime(output_path), os.path.getmtime(vis_path))
+        return all(os.path.getmtime(cogs[band]) < oldest for band in bands)
+    
+    def _apply_band_kernel(self, kernel, band1, band2, output_path, **tags):
+        """
+        Stream two bands through a pixel kernel one COG tile at a time
+        
+        Each tile of band1 and band2 is read in its native dtype, passed through
+        kernel(a, b, out) and written to output_path straight away, so only
+        the tiles touched are decompressed. The kernels also report each
+        tile's min/max, so the value range comes out of the same pass.
+        If either input has a nodata value or mask, the output gets a mask
+        that is valid only where both inputs are.
+        
+        Returns (result, (vmin, vmax)) with the full float32 result for the
+        visualization, or (None, None) if the bands cannot be used.
+        """
+        cogs = self.cogs
+        
+        for band in (band1, band2):
+            if band not in cogs:
+                print(f"Band {band} not found as a COG file")
+                print("Could not load band data")
+                return None, None
+        
+        with rasterio.open(cogs[band1]) as src1, rasterio.open(cogs[band2]) as src2:
+            if src1.shape != src2.shape:
+                print("Band shapes do not match")
+                return None, None
+            
+            profile = self._output_profile(src1.profile)
+            result = np.empty(src1.shape, dtype=np.float32)
+            vmin, vmax = np.inf, -np.inf
+            
+            # One set of tile buffers is reused for every window. They are
+            # flat so that the (smaller) edge tiles can be taken as
+            # contiguous reshaped prefixes rather than strided slices.
+            # Inputs stay in the bands' native dtype: the kernels cast to
+            # float32 per pixel, so GDAL does no conversion pass and the
+            # input tiles take half the memory for uint16 bands.
+            block_height, block_width = src1.block_shapes[0]
+            a_buf = np.empty(block_height * block_width, dtype=src1.dtypes[0])
+            b_buf = np.empty(block_height * block_width, dtype=src2.dtypes[0])
+            tile_buf = np.empty(block_height * block_width, dtype=np.float32)
+            
+            masked = any(MaskFlags.all_valid not in src.mask_flag_enums[0]
+                         for src in (src1, src2))
+            if masked:
+                mask_a_buf = np.empty(block_height * block_width, dtype=np.uint8)
+                mask_b_buf = np.empty(block_height * block_width, dtype=np.uint8)
+            
+            # Windows follow band1's tiling; with matching tilings (the
+            # normal case for COGs from the converter) every read is a
+            # whole tile of both inputs
+            # Written to a temporary file and moved into place when complete,
+            # so an interrupted run cannot leave a truncated result that
+            # _is_fresh would later take as current
+            with atomic_output(output_path) as tmp_path, \
+                    rasterio.open(tmp_path, 'w', **profile) as dst:
+                for _, window in src1.block_windows(1):
+                    shape = (window.height, window.width)
+                    size = window.height * window.width
+                    a = a_buf[:size].reshape(shape)
+                    b = b_buf[:size].reshape(shape)
+                    tile = tile_buf[:size].reshape(shape)
+                    
+                    src1.read(1, window=window, out=a)
+                    src2.read(1, window=window, out=b)
+                    tile_min, tile_max = kernel(a, b, tile)
+                    vmin = min(vmin, tile_min)
+                    vmax = max(vmax, tile_max)
+                    
+                    dst.write(tile, 1, window=window)
+                    
+                    if masked:
+                        mask_a = mask_a_buf[:size].reshape(shape)
+                        mask_b = mask_b_buf[:size].reshape(shape)
+                        src1.read_masks(1, window=window, out=mask_a)
+                        src2.read_masks(1, window=window, out=mask_b)
+                        np.minimum(mask_a, mask_b, out=mask_a)
+                        dst.write_mask(mask_a, window=window)
+                    
+                    rows, cols = window.toslices()
+                    result[rows, cols] = tile
+                
+                dst.update_tags(**tags)
+        
+        return result, (float(vmin), float(vmax))
+    
+    def band_difference(self, band1, band2, output_name=None, force=False):
         """
         Calculate the difference between two bands (band1 - band2)
         Useful for change detection or highlighting specific features
@@ -68,51 +238,47 @@ class INSATBandManipulator:
             output_name = f"diff_{band1}_{band2}"
             
         output_path = os.path.join(self.output_directory, f"{output_name}.tif")
+        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
         
-        # Load band data
-        data1, profile1 = self.load_band_data(band1)
-        data2, profile2 = self.load_band_data(band2)
-        
-        if data1 is None or data2 is None:
-            print("Could not load band data")
-            return None
+        # Concurrent requests for this result wait here, then find it fresh
+        with output_lock(output_path):
+            # Reuse an earlier result when it is newer than both inputs
+            if not force and self._is_fresh(output_path, vis_path, band1, band2):
+                print(f"✅ Band difference up to date: {output_path}")
+                return output_path
             
-        if data1.shape != data2.shape:
-            print("Band shapes do not match")
-            return None
-            
-        # Calculate difference
-        diff_data = data1.astype(np.float32) - data2.astype(np.float32)
-        
-        # Write output
-        profile1.update(dtype=rasterio.float32)
-        with rasterio.open(output_path, 'w', **profile1) as dst:
-            dst.write(diff_data, 1)
-            dst.update_tags(
+            # Calculate difference tile by tile and write output
+            diff_data, value_range = self._apply_band_kernel(
+                band_difference_kernel, band1, band2, output_path,
                 OPERATION="DIFFERENCE",
                 BAND1=band1,
                 BAND2=band2
             )
+            if diff_data is None:
+                return None
+                
+            # Create visualization
+            with self._render_lock:
+                fig = self._figure((10, 8))
+                ax = fig.add_subplot()
+                ax.set_title(f"Band Difference: {band1} - {band2}")
+                # The range came out of the compute pass, so imshow does not
+                # have to scan the raster again to autoscale
+                image = ax.imshow(diff_data, cmap='coolwarm', vmin=value_range[0], vmax=value_range[1])
+                fig.colorbar(image, ax=ax, label='Difference')
+                ax.axis('off')
+                fig.tight_layout()
             
-        # Create visualization
-        plt.figure(figsize=(10, 8))
-        plt.title(f"Band Difference: {band1} - {band2}")
-        plt.imshow(diff_data, cmap='coolwarm')
-        plt.colorbar(label='Difference')
-        plt.axis('off')
-        plt.tight_layout()
-        
-        # Save visualization
-        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
-        plt.savefig(vis_path, dpi=300, bbox_inches='tight')
-        plt.close()
+                # Save visualization
+                with atomic_output(vis_path) as tmp_path:
+                    fig.savefig(tmp_path, dpi=100, bbox_inches=None, pil_kwargs={'compress_level': 1})
+                
+            print(f"✅ Band difference calculated: {output_path}")
+            print(f"✅ Visualization saved: {vis_path}")
             
-        print(f"✅ Band difference calculated: {output_path}")
-        print(f"✅ Visualization saved: {vis_path}")
-        
-        return output_path
+            return output_path
     
-    def band_ratio(self, band_numerator, band_denominator, output_name=None):
+    def band_ratio(self, band_numerator, band_denominator, output_name=None, force=False):
         """
         Calculate the ratio between two bands (numerator / denominator)
         Useful for indices like NDVI, NDWI, etc.
@@ -121,57 +287,53 @@ class INSATBandManipulator:
             output_name = f"ratio_{band_numerator}_{band_denominator}"
             
         output_path = os.path.join(self.output_directory, f"{output_name}.tif")
+        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
         
-        # Load band data
-        data1, profile1 = self.load_band_data(band_numerator)
-        data2, profile2 = self.load_band_data(band_denominator)
-        
-        if data1 is None or data2 is None:
-            print("Could not load band data")
-            return None
+        # Concurrent requests for this result wait here, then find it fresh
+        with output_lock(output_path):
+            # Reuse an earlier result when it is newer than both inputs
+            if not force and self._is_fresh(output_path, vis_path, band_numerator, band_denominator):
+                print(f"✅ Band ratio up to date: {output_path}")
+                return output_path
             
-        if data1.shape != data2.shape:
-            print("Band shapes do not match")
-            return None
-            
-        # Avoid division by zero
-        valid_mask = data2 != 0
-        ratio_data = np.zeros_like(data1, dtype=np.float32)
-        ratio_data[valid_mask] = data1[valid_mask].astype(np.float32) / data2[valid_mask].astype(np.float32)
-        
-        # Write output
-        profile1.update(dtype=rasterio.float32)
-        with rasterio.open(output_path, 'w', **profile1) as dst:
-            dst.write(ratio_data, 1)
-            dst.update_tags(
+            # Calculate ratio tile by tile (0 where the denominator is zero)
+            ratio_data, _ = self._apply_band_kernel(
+                band_ratio_kernel, band_numerator, band_denominator, output_path,
                 OPERATION="RATIO",
                 NUMERATOR=band_numerator,
                 DENOMINATOR=band_denominator
             )
+            if ratio_data is None:
+                return None
+                
+            # Create visualization (with normalization for better display).
+            # Extreme values are clipped through the color limits rather than
+            # by materializing a clipped copy of the raster; the percentiles
+            # skip the zero fill written where the denominator is zero. The
+            # raster is strided down to ~1M pixels first, so only that view
+            # is masked rather than the full raster.
+            sample = ratio_data.ravel()[::max(1, ratio_data.size // 1_000_000)]
+            p2, p98 = fast_stretch_bounds(sample[sample != 0])
             
-        # Create visualization (with normalization for better display)
-        # Clip extreme values for better visualization
-        p2, p98 = np.percentile(ratio_data[valid_mask], (2, 98))
-        display_data = np.clip(ratio_data, p2, p98)
-        
-        plt.figure(figsize=(10, 8))
-        plt.title(f"Band Ratio: {band_numerator} / {band_denominator}")
-        plt.imshow(display_data, cmap='viridis')
-        plt.colorbar(label='Ratio')
-        plt.axis('off')
-        plt.tight_layout()
-        
-        # Save visualization
-        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
-        plt.savefig(vis_path, dpi=300, bbox_inches='tight')
-        plt.close()
+            with self._render_lock:
+                fig = self._figure((10, 8))
+                ax = fig.add_subplot()
+                ax.set_title(f"Band Ratio: {band_numerator} / {band_denominator}")
+                image = ax.imshow(ratio_data, cmap='viridis', vmin=p2, vmax=p98)
+                fig.colorbar(image, ax=ax, label='Ratio')
+                ax.axis('off')
+                fig.tight_layout()
             
-        print(f"✅ Band ratio calculated: {output_path}")
-        print(f"✅ Visualization saved: {vis_path}")
-        
-        return output_path
+                # Save visualization
+                with atomic_output(vis_path) as tmp_path:
+                    fig.savefig(tmp_path, dpi=100, bbox_inches=None, pil_kwargs={'compress_level': 1})
+                
+            print(f"✅ Band ratio calculated: {output_path}")
+            print(f"✅ Visualization saved: {vis_path}")
+            
+            return output_path
     
-    def normalized_difference_index(self, band1, band2, output_name=None):
+    def normalized_difference_index(self, band1, band2, output_name=None, force=False):
         """
         Calculate normalized difference index between two bands: (band1 - band2) / (band1 + band2)
         This is the generalized form of indices like NDVI, NDWI, etc.
@@ -180,61 +342,44 @@ class INSATBandManipulator:
             output_name = f"NDI_{band1}_{band2}"
             
         output_path = os.path.join(self.output_directory, f"{output_name}.tif")
+        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
         
-        # Load band data
-        data1, profile1 = self.load_band_data(band1)
-        data2, profile2 = self.load_band_data(band2)
-        
-        if data1 is None or data2 is None:
-            print("Could not load band data")
-            return None
+        # Concurrent requests for this result wait here, then find it fresh
+        with output_lock(output_path):
+            # Reuse an earlier result when it is newer than both inputs
+            if not force and self._is_fresh(output_path, vis_path, band1, band2):
+                print(f"✅ Normalized Difference Index up to date: {output_path}")
+                return output_path
             
-        if data1.shape != data2.shape:
-            print("Band shapes do not match")
-            return None
-            
-        # Convert to float
-        data1 = data1.astype(np.float32)
-        data2 = data2.astype(np.float32)
-        
-        # Calculate normalized difference index
-        sum_data = data1 + data2
-        diff_data = data1 - data2
-        
-        # Avoid division by zero
-        valid_mask = sum_data != 0
-        ndi_data = np.zeros_like(sum_data, dtype=np.float32)
-        ndi_data[valid_mask] = diff_data[valid_mask] / sum_data[valid_mask]
-        
-        # NDI ranges from -1 to 1
-        
-        # Write output
-        profile1.update(dtype=rasterio.float32)
-        with rasterio.open(output_path, 'w', **profile1) as dst:
-            dst.write(ndi_data, 1)
-            dst.update_tags(
+            # Calculate normalized difference index tile by tile
+            # (0 where band1 + band2 == 0); NDI ranges from -1 to 1
+            ndi_data, _ = self._apply_band_kernel(
+                ndi_kernel, band1, band2, output_path,
                 OPERATION="NORMALIZED_DIFFERENCE_INDEX",
                 BAND1=band1,
                 BAND2=band2
             )
+            if ndi_data is None:
+                return None
+                
+            # Create visualization
+            with self._render_lock:
+                fig = self._figure((10, 8))
+                ax = fig.add_subplot()
+                ax.set_title(f"Normalized Difference Index: {band1} & {band2}")
+                image = ax.imshow(ndi_data, cmap='RdYlGn', vmin=-1, vmax=1)
+                fig.colorbar(image, ax=ax, label='NDI (-1 to 1)')
+                ax.axis('off')
+                fig.tight_layout()
             
-        # Create visualization
-        plt.figure(figsize=(10, 8))
-        plt.title(f"Normalized Difference Index: {band1} & {band2}")
-        plt.imshow(ndi_data, cmap='RdYlGn', vmin=-1, vmax=1)
-        plt.colorbar(label='NDI (-1 to 1)')
-        plt.axis('off')
-        plt.tight_layout()
-        
-        # Save visualization
-        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
-        plt.savefig(vis_path, dpi=300, bbox_inches='tight')
-        plt.close()
+                # Save visualization
+                with atomic_output(vis_path) as tmp_path:
+                    fig.savefig(tmp_path, dpi=100, bbox_inches=None, pil_kwargs={'compress_level': 1})
+                
+            print(f"✅ Normalized Difference Index calculated: {output_path}")
+            print(f"✅ Visualization saved: {vis_path}")
             
-        print(f"✅ Normalized Difference Index calculated: {output_path}")
-        print(f"✅ Visualization saved: {vis_path}")
-        
-        return output_path
+            return output_path
     
     def extract_region(self, band_name, x_start, y_start, width, height, output_name=None):
         """
@@ -251,7 +396,7 @@ class INSATBandManipulator:
             
         output_path = os.path.join(self.output_directory, f"{output_name}.tif")
         
-        cogs = self.get_available_cogs()
+        cogs = self.cogs
         if band_name not in cogs:
             print(f"Band {band_name} not found as a COG file")
             return None
@@ -273,7 +418,8 @@ class INSATBandManipulator:
             })
             
             # Write the region to a new file
-            with rasterio.open(output_path, 'w', **profile) as dst:
+            with atomic_output(output_path) as tmp_path, \
+                    rasterio.open(tmp_path, 'w', **profile) as dst:
                 dst.write(region_data, 1)
                 dst.update_tags(
                     PARENT_BAND=band_name,
@@ -284,17 +430,19 @@ class INSATBandManipulator:
                 )
         
         # Create visualization
-        plt.figure(figsize=(10, 8))
-        plt.title(f"Region from {band_name}")
-        plt.imshow(region_data, cmap='gray')
-        plt.colorbar(label='Value')
-        plt.axis('off')
-        plt.tight_layout()
-        
-        # Save visualization
-        vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
-        plt.savefig(vis_path, dpi=300, bbox_inches='tight')
-        plt.close()
+        with self._render_lock:
+            fig = self._figure((10, 8))
+            ax = fig.add_subplot()
+            ax.set_title(f"Region from {band_name}")
+            image = ax.imshow(region_data, cmap='gray')
+            fig.colorbar(image, ax=ax, label='Value')
+            ax.axis('off')
+            fig.tight_layout()
+        
+            # Save visualization
+            vis_path = os.path.join(self.output_directory, f"{output_name}_vis.png")
+            with atomic_output(vis_path) as tmp_path:
+                fig.savefig(tmp_path, dpi=100, bbox_inches=None, pil_kwargs={'compress_level': 1})
             
         print(f"✅ Region extracted: {output_path}")
         print(f"✅ Visualization saved: {vis_path}")
@@ -309,7 +457,7 @@ def demo_manipulations():
     manipulator = INSATBandManipulator()
     
     # Check for available COGs
-    cogs = manipulator.get_available_cogs()
+    cogs = manipulator.cogs
     if not cogs:
         print("No COG files found. Please convert bands to COG format first.")
         return
@@ -355,4 +503,6 @@ def demo_manipulations():
     print(f"\n✅ All manipulations saved to: {manipulator.output_directory}")
 
 if __name__ == "__main__":
+    # The package-relative imports above need src imported as a package, so
+    # run the demo from the repository root: python -m src.manipulations
     demo_manipulations()
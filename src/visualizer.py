@@ -1,11 +1,79 @@
+import io
 import os
+import threading
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+import matplotlib
+matplotlib.use('Agg')
 import rasterio
-from rasterio.plot import show
-import h5py
-from PIL import Image
+from rasterio.enums import Resampling
+
+from .file_utils import atomic_output, output_lock
+from .h5_reader import open_h5
+from .kernels import fast_stretch_bounds
+
+# Band listing and stretch bounds cache kept in the COG directory
+MANIFEST_NAME = "manifest.json"
+
+# Smallest long-side size (pixels) a comparison panel is downsampled to
+COMPARISON_MIN_SIZE = 1024
+
+# GDAL settings for bulk COG reads: a larger block cache and multithreaded
+# DEFLATE decoding
+GDAL_READ_OPTIONS = {
+    'GDAL_CACHEMAX': 512,
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+}
+
+def _read_band_into(path, out):
+    """
+    Read band 1 of a raster into a preallocated array
+    
+    GDAL configuration set by rasterio.Env is thread-local, so reader
+    threads enter their own Env.
+    """
+    with rasterio.Env(**GDAL_READ_OPTIONS), rasterio.open(path) as src:
+        src.read(1, out=out)
+
+def _overview_factor(src):
+    """
+    Decimation factor of the coarsest overview that still leaves the
+    longer side at COMPARISON_MIN_SIZE pixels or more (1 if none does)
+    """
+    factor = 1
+    for ov in src.overviews(1):
+        if max(src.height, src.width) // ov >= COMPARISON_MIN_SIZE:
+            factor = ov
+    return factor
+
+_worker_env = None
+
+def _pool_context():
+    """
+    Start pool workers from a forkserver where available, so the heavy
+    imports are paid once by the server instead of by every worker
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return None
+
+def _init_visualization_worker():
+    """
+    Process pool initializer: keep one GDAL environment (warm block cache)
+    per worker
+    """
+    global _worker_env
+    _worker_env = rasterio.Env(**GDAL_READ_OPTIONS)
+    _worker_env.__enter__()
+
+def _visualization_worker(visualizer, method_name, args):
+    """
+    Process pool entry point: run one visualization with a pickled visualizer
+    """
+    return getattr(visualizer, method_name)(*args)
 
 class INSATVisualizer:
     def __init__(self, cog_directory="../../output/converted_cogs", output_directory="../../output/visualizations"):
@@ -18,6 +86,11 @@ class INSATVisualizer:
         # Create output directory if it doesn't exist
         os.makedirs(output_directory, exist_ok=True)
         
+        # Reusable figure for rendering, created on first use, and the lock
+        # that serializes its use when the instance is shared across threads
+        self._fig = None
+        self._render_lock = threading.RLock()
+        
         # Define common band combinations
         self.band_combinations = {
             "natural_color": ["IMG_VIS", "IMG_SWIR", "IMG_TIR1"],
@@ -25,18 +98,175 @@ class INSATVisualizer:
             "thermal": ["IMG_TIR1", "IMG_TIR2", "IMG_MIR"]
         }
     
+    def __getstate__(self):
+        # The figure and lock are per process; workers create their own
+        state = self.__dict__.copy()
+        state['_fig'] = None
+        del state['_render_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._render_lock = threading.RLock()
+    
+    def _figure(self, figsize):
+        """
+        Return this instance's reusable figure, cleared and resized
+        
+        Creating a pyplot figure per plot pays for figure setup and
+        teardown every time; one Agg Figure per instance is reused instead.
+        """
+        if self._fig is None:
+            from matplotlib.figure import Figure
+            self._fig = Figure()
+        self._fig.clear()
+        self._fig.set_size_inches(figsize)
+        return self._fig
+    
+    @cached_property
+    def manifest(self):
+        """
+        Per-band COG metadata, persisted as manifest.json in the COG directory
+        
+        Maps band name to {'file', 'mtime_ns'} plus the cached 'p2'/'p98'
+        display stretch bounds once computed. The stored manifest is trusted
+        while it is at least as new as the directory; otherwise the directory
+        is rescanned and stretch bounds are kept for unchanged files.
+        """
+        if not os.path.exists(self.cog_directory):
+            return {}
+        
+        manifest_path = os.path.join(self.cog_directory, MANIFEST_NAME)
+        stored = {}
+        try:
+            with open(manifest_path) as f:
+                stored = json.load(f)
+            if os.stat(manifest_path).st_mtime_ns >= os.stat(self.cog_directory).st_mtime_ns:
+                return stored
+        except (OSError, ValueError):
+            pass
+        
+        manifest = {}
+        with os.scandir(self.cog_directory) as entries:
+            for entry in entries:
+                if entry.name.endswith("_cog.tif"):
+                    band_name = entry.name[:-len("_cog.tif")]
+                    mtime_ns = entry.stat().st_mtime_ns
+                    previous = stored.get(band_name, {})
+                    if previous.get('mtime_ns') == mtime_ns:
+                        manifest[band_name] = previous
+                    else:
+                        manifest[band_name] = {'file': entry.name, 'mtime_ns': mtime_ns}
+        
+        self._save_manifest(manifest)
+        return manifest
+    
+    def _save_manifest(self, manifest):
+        """
+        Write the manifest atomically, so readers in other processes never
+        load a half-written file (a read-only COG directory is not an error)
+        """
+        manifest_path = os.path.join(self.cog_directory, MANIFEST_NAME)
+        try:
+            with self._render_lock, atomic_output(manifest_path) as tmp_path, \
+                    open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+        except OSError:
+            pass
+    
+    def _stretch_bounds(self, band_name, data=None):
+        """
+        2/98 stretch bounds for a band, from the manifest when still valid,
+        otherwise computed and recorded
+        
+        The bounds are always taken from the full-resolution band in its
+        native dtype (an exact histogram for 16-bit bands), so a band gets
+        the same stretch whichever caller computed it first. Pass data only
+        when it is that array; otherwise the COG is read here.
+        
+        Safe to call from several threads (the RGB channel readers do): the
+        manifest entry is only read, updated and saved under _render_lock,
+        so json.dump never sees a dict that another thread is changing.
+        """
+        path = self.cogs[band_name]
+        entry = self.manifest.get(band_name)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._render_lock:
+            if entry is not None and 'p2' in entry and entry['mtime_ns'] == mtime_ns:
+                return entry['p2'], entry['p98']
+        
+        if data is None:
+            with rasterio.open(path) as src:
+                data = src.read(1)
+        p2, p98 = (float(bound) for bound in fast_stretch_bounds(data))
+        if entry is not None:
+            with self._render_lock:
+                entry.update(mtime_ns=mtime_ns, p2=p2, p98=p98)
+                self._save_manifest(self.manifest)
+        return p2, p98
+    
+    def _prime_stretch_bounds(self):
+        """
+        Record stretch bounds for every band, so that pool workers only
+        ever read the manifest
+        """
+        for band_name in self.cogs:
+            self._stretch_bounds(band_name)
+    
+    @cached_property
+    def cogs(self):
+        """
+        Mapping of band name to COG file path, from the manifest
+        
+        Call invalidate_cogs() after new COGs are written to the directory.
+        """
+        return {band_name: os.path.join(self.cog_directory, entry['file'])
+                for band_name, entry in self.manifest.items()}
+    
+    def invalidate_cogs(self):
+        """
+        Drop the cached COG listing so the next access rescans the directory
+        """
+        self.__dict__.pop('cogs', None)
+        self.__dict__.pop('manifest', None)
+    
     def get_available_cogs(self):
         """
         Get a list of available COG files in the directory
         """
-        cog_files = {}
-        if os.path.exists(self.cog_directory):
-            for filename in os.listdir(self.cog_directory):
-                if filename.endswith("_cog.tif"):
-                    band_name = filename.split("_cog.tif")[0]
-                    cog_files[band_name] = os.path.join(self.cog_directory, filename)
+        return self.cogs
+    
+    def _render_single_band(self, band_name, target, colormap, stretch):
+        """
+        Render a single band figure as PNG into target (a path or a
+        binary file object)
+        """
+        with rasterio.open(self.cogs[band_name]) as src:
+            # Read the data
+            band_data = src.read(1)
+        
+        # Apply contrast stretching if requested, in place
+        if stretch:
+            p2, p98 = self._stretch_bounds(band_name, band_data)
+            band_data = band_data.astype(np.float32)
+            np.clip(band_data, p2, p98, out=band_data)
+            np.subtract(band_data, np.float32(p2), out=band_data)
+            if p98 > p2:
+                np.multiply(band_data, np.float32(1.0 / (p98 - p2)), out=band_data)
         
-        return cog_files
+        # Create the plot
+        with self._render_lock:
+            fig = self._figure((10, 10))
+            ax = fig.add_subplot()
+            ax.set_title(f"{band_name} Band Visualization")
+            image = ax.imshow(band_data, cmap=colormap)
+            fig.colorbar(image, ax=ax, label=f"{band_name} Values")
+            ax.axis('off')
+            fig.tight_layout()
+            
+            # Save the figure
+            fig.savefig(target, format='png', dpi=100, bbox_inches=None,
+                        pil_kwargs={'compress_level': 1})
     
     def visualize_single_band(self, band_name, colormap='gray', stretch=True):
         """
@@ -47,40 +277,29 @@ class INSATVisualizer:
             colormap: Matplotlib colormap name to use
             stretch: Apply contrast stretching to enhance visibility
         """
-        cogs = self.get_available_cogs()
-        
-        if band_name not in cogs:
+        if band_name not in self.cogs:
             print(f"Band {band_name} not found as a COG file")
             return None
         
         output_path = os.path.join(self.output_directory, f"{band_name}_visualization.png")
+        with output_lock(output_path), atomic_output(output_path) as tmp_path:
+            self._render_single_band(band_name, tmp_path, colormap, stretch)
+        print(f"✅ Visualization saved to {output_path}")
         
-        with rasterio.open(cogs[band_name]) as src:
-            # Read the data
-            band_data = src.read(1)
-            
-            # Apply contrast stretching if requested
-            if stretch:
-                p2, p98 = np.percentile(band_data, (2, 98))
-                band_data = np.clip(band_data, p2, p98)
-                band_data = (band_data - p2) / (p98 - p2)
-            
-            # Create the plot
-            plt.figure(figsize=(10, 10))
-            plt.title(f"{band_name} Band Visualization")
-            plt.imshow(band_data, cmap=colormap)
-            plt.colorbar(label=f"{band_name} Values")
-            plt.axis('off')
-            plt.tight_layout()
-            
-            # Save the figure
-            plt.savefig(output_path, dpi=300, bbox_inches='tight')
-            plt.close()
-            
-            print(f"✅ Visualization saved to {output_path}")
-            
         return output_path
     
+    def render_single_band_bytes(self, band_name, colormap='gray', stretch=True):
+        """
+        Same figure as visualize_single_band, returned as PNG bytes instead
+        of being written to the output directory (None if the band has no COG)
+        """
+        if band_name not in self.cogs:
+            return None
+        
+        buffer = io.BytesIO()
+        self._render_single_band(band_name, buffer, colormap, stretch)
+        return buffer.getvalue()
+    
     def create_rgb_composite(self, red_band, green_band, blue_band, output_name=None, stretch=True):
         """
         Create an RGB composite from three different bands
@@ -92,7 +311,7 @@ class INSATVisualizer:
             output_name: Custom name for the output file
             stretch: Apply contrast stretching to enhance visibility
         """
-        cogs = self.get_available_cogs()
+        cogs = self.cogs
         
         # Check if all bands exist
         for band in [red_band, green_band, blue_band]:
@@ -105,50 +324,46 @@ class INSATVisualizer:
         
         output_path = os.path.join(self.output_directory, f"{output_name}.png")
         
-        # Create RGB array
-        red_data = None
-        green_data = None
-        blue_data = None
-        
-        # Read data for each channel
-        with rasterio.open(cogs[red_band]) as src:
-            red_data = src.read(1).astype(np.float32)
-            profile = src.profile
-        
-        with rasterio.open(cogs[green_band]) as src:
-            green_data = src.read(1).astype(np.float32)
-        
-        with rasterio.open(cogs[blue_band]) as src:
-            blue_data = src.read(1).astype(np.float32)
-        
-        # Apply contrast stretching if requested
-        if stretch:
-            for data in [red_data, green_data, blue_data]:
-                p2, p98 = np.percentile(data, (2, 98))
-                data = np.clip(data, p2, p98)
-                data = (data - p2) / (p98 - p2)
-        
-        # Stack bands to create RGB
-        rgb = np.dstack((red_data, green_data, blue_data))
-        
-        # Normalize to 0-1 range if not already
-        if rgb.max() > 1:
-            rgb = rgb / rgb.max()
-        
-        # Create the plot
-        plt.figure(figsize=(12, 12))
-        plt.title(f"RGB Composite: {red_band}(R), {green_band}(G), {blue_band}(B)")
-        plt.imshow(rgb)
-        plt.axis('off')
-        plt.tight_layout()
-        
-        # Save the figure
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
-        plt.close()
-        
-        print(f"✅ RGB composite saved to {output_path}")
-        
-        return output_path
+        # Concurrent requests for the same composite are written one at a time
+        with output_lock(output_path):
+            # Read each channel straight into its plane of a preallocated 3xHxW
+            # buffer. Planes are C-contiguous, so rasterio reads into them
+            # without a staging copy; the HxWx3 image is a transposed view.
+            with rasterio.open(cogs[red_band]) as src:
+                height, width = src.shape
+            chw = np.empty((3, height, width), dtype=np.float32)
+            
+            def load_channel(i):
+                """Read one channel into its plane and stretch it to 0-1 in place"""
+                channel = chw[i]
+                _read_band_into(cogs[bands[i]], channel)
+                if stretch:
+                    lo, hi = self._stretch_bounds(bands[i])
+                else:
+                    lo, hi = channel.min(), channel.max()
+                np.subtract(channel, np.float32(lo), out=channel)
+                if hi > lo:
+                    np.multiply(channel, np.float32(1.0 / (hi - lo)), out=channel)
+                np.clip(channel, 0, 1, out=channel)
+            
+            # rasterio releases the GIL while reading and NumPy while scaling,
+            # so each channel is read and stretched on its own thread
+            bands = [red_band, green_band, blue_band]
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                list(executor.map(load_channel, range(3)))
+            
+            # The composite is just pixels (no axes or colorbar), so write it
+            # at native resolution with PIL instead of rendering a figure. The
+            # uint8 cast also interleaves the planes into HxWx3 in one pass.
+            from PIL import Image
+            np.multiply(chw, 255, out=chw)
+            rgb = np.moveaxis(chw, 0, -1).astype(np.uint8, order='C')
+            with atomic_output(output_path) as tmp_path:
+                Image.fromarray(rgb).save(tmp_path, format='PNG', optimize=False, compress_level=1)
+            
+            print(f"✅ RGB composite saved to {output_path}")
+            
+            return output_path
     
     def visualize_band_combination(self, combination_name):
         """
@@ -175,85 +390,115 @@ class INSATVisualizer:
             band_name: Name of the band to compare
             h5_file_path: Path to the original H5 file
         """
-        cogs = self.get_available_cogs()
+        cogs = self.cogs
         output_path = os.path.join(self.output_directory, f"{band_name}_comparison.png")
         
         if band_name not in cogs:
             print(f"Band {band_name} not found as a COG file")
             return None
         
-        # Read original H5 data
-        with h5py.File(h5_file_path, 'r') as f:
+        # Read the COG once, from the coarsest overview that still leaves
+        # the longer side at COMPARISON_MIN_SIZE pixels or more
+        with rasterio.Env(**GDAL_READ_OPTIONS), rasterio.open(cogs[band_name]) as src:
+            factor = _overview_factor(src)
+            out_shape = (-(-src.height // factor), -(-src.width // factor))
+            cog_data = src.read(1, out_shape=out_shape, resampling=Resampling.average)
+        
+        # Read original H5 data at the same stride
+        with open_h5(h5_file_path) as f:
             if band_name not in f:
                 print(f"Band {band_name} not found in original H5 file")
                 return None
             
-            original_data = f[band_name]
+            dataset = f[band_name]
             
             # Handle 3D data (time, y, x)
-            if len(original_data.shape) == 3:
-                original_data = original_data[0, :, :]
+            if dataset.ndim == 3:
+                source_sel = np.s_[0, ::factor, ::factor]
             else:
-                original_data = original_data[:, :]
+                source_sel = np.s_[::factor, ::factor]
+            
+            # HDF5 converts straight into the float32 buffer, with no
+            # intermediate array in the native dtype
+            original_data = np.empty(out_shape, dtype=np.float32)
+            dataset.read_direct(original_data, source_sel=source_sel)
         
-        # Read COG data
-        with rasterio.open(cogs[band_name]) as src:
-            cog_data = src.read(1)
+        # The conversion is lossless, so one set of stretch bounds serves
+        # both panels
+        p2, p98 = self._stretch_bounds(band_name)
         
         # Create the comparison plot
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 10))
-        
-        # Plot original data
-        p2, p98 = np.percentile(original_data, (2, 98))
-        orig_img = ax1.imshow(original_data, cmap='gray', vmin=p2, vmax=p98)
-        ax1.set_title(f"Original {band_name} (H5)")
-        ax1.axis('off')
-        fig.colorbar(orig_img, ax=ax1)
-        
-        # Plot COG data
-        p2, p98 = np.percentile(cog_data, (2, 98))
-        cog_img = ax2.imshow(cog_data, cmap='gray', vmin=p2, vmax=p98)
-        ax2.set_title(f"COG {band_name}")
-        ax2.axis('off')
-        fig.colorbar(cog_img, ax=ax2)
-        
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
-        plt.close()
+        with self._render_lock:
+            fig = self._figure((20, 10))
+            ax1, ax2 = fig.subplots(1, 2)
+        
+            # Plot original data
+            orig_img = ax1.imshow(original_data, cmap='gray', vmin=p2, vmax=p98)
+            ax1.set_title(f"Original {band_name} (H5)")
+            ax1.axis('off')
+            fig.colorbar(orig_img, ax=ax1)
+        
+            # Plot COG data
+            cog_img = ax2.imshow(cog_data, cmap='gray', vmin=p2, vmax=p98)
+            ax2.set_title(f"COG {band_name}")
+            ax2.axis('off')
+            fig.colorbar(cog_img, ax=ax2)
+        
+            fig.tight_layout()
+            with atomic_output(output_path) as tmp_path:
+                fig.savefig(tmp_path, dpi=100, bbox_inches=None, pil_kwargs={'compress_level': 1})
         
         print(f"✅ Comparison saved to {output_path}")
         
         return output_path
     
-    def create_all_visualizations(self, h5_file_path):
+    def create_all_visualizations(self, h5_file_path, max_workers=None):
         """
         Create all possible visualizations from the available COG files
         
+        Every single band view, band combination and comparison is
+        independent, so they are rendered in parallel worker processes.
+        Pass max_workers=1 to render serially, e.g. for debugging.
+        
         Args:
             h5_file_path: Path to the original H5 file for comparison
+            max_workers: Number of worker processes (default: one per task, up to the CPU count)
         """
-        cogs = self.get_available_cogs()
+        cogs = self.cogs
         
         if not cogs:
             print("No COG files found to visualize")
             return {}
         
-        results = {}
-        
-        # Create single band visualizations
-        print("\nCreating single band visualizations...")
+        tasks = []
         for band_name in cogs:
-            results[f"{band_name}_grayscale"] = self.visualize_single_band(band_name)
-        
-        # Create predefined band combinations
-        print("\nCreating band combinations...")
+            tasks.append((f"{band_name}_grayscale", "visualize_single_band", (band_name,)))
         for combo_name in self.band_combinations:
-            results[combo_name] = self.visualize_band_combination(combo_name)
-        
-        # Create comparisons
-        print("\nCreating original vs COG comparisons...")
+            tasks.append((combo_name, "visualize_band_combination", (combo_name,)))
         for band_name in cogs:
-            results[f"{band_name}_comparison"] = self.compare_original_vs_cog(band_name, h5_file_path)
+            tasks.append((f"{band_name}_comparison", "compare_original_vs_cog", (band_name, h5_file_path)))
+        
+        if max_workers is None:
+            max_workers = min(len(tasks), os.cpu_count() or 1)
+        
+        print(f"\nCreating {len(tasks)} visualizations...")
+        if max_workers > 1:
+            # Workers share the manifest read-only
+            with rasterio.Env(**GDAL_READ_OPTIONS):
+                self._prime_stretch_bounds()
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=_pool_context(),
+                                     initializer=_init_visualization_worker) as executor:
+                futures = [executor.submit(_visualization_worker, self, method_name, args)
+                           for _, method_name, args in tasks]
+                outputs = [future.result() for future in futures]
+        else:
+            with rasterio.Env(**GDAL_READ_OPTIONS):
+                outputs = [getattr(self, method_name)(*args) for _, method_name, args in tasks]
+        
+        results = {}
+        for (key, _, _), output_path in zip(tasks, outputs):
+            results[key] = output_path
         
         return results
 
@@ -271,7 +516,7 @@ def demo_visualization():
     vis = INSATVisualizer()
     
     # Check for available COGs
-    cogs = vis.get_available_cogs()
+    cogs = vis.cogs
     if not cogs:
         print("No COG files found. Please convert bands to COG format first.")
         return
@@ -294,4 +539,6 @@ def demo_visualization():
     vis.compare_original_vs_cog(first_band, h5_file)
 
 if __name__ == "__main__":
+    # The package-relative imports above need src imported as a package, so
+    # run the demo from the repository root: python -m src.visualizer
     demo_visualization()
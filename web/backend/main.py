@@ -1,74 +1,303 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict
 import sys
 import os
+import stat
 from pathlib import Path
 import json
+from email.utils import formatdate, parsedate_to_datetime
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+import rasterio
 
 # Add the parent directory to Python path to import our existing modules
 sys.path.append(str(Path(__file__).parent.parent.parent))
 
-from src.h5_reader import explore_h5_structure, get_basic_info
+from src.h5_reader import explore_h5_structure, get_basic_info, open_h5
 from src.cog_converter import INSATCOGConverter
 from src.visualizer import INSATVisualizer
 from src.manipulations import INSATBandManipulator
+from src.kernels import band_stats_kernel
 
-app = FastAPI(title="INSAT COG Explorer API")
+@asynccontextmanager
+async def lifespan(app):
+    """Open the HDF5 file once for the life of the server"""
+    # Every conversion reads through this handle, so the superblock and
+    # metadata are parsed once and the chunk cache stays warm across requests
+    app.state.h5_mtime_ns = os.stat(h5_file_path).st_mtime_ns
+    app.state.h5 = open_h5(h5_file_path)
+    try:
+        yield
+    finally:
+        app.state.h5.close()
+
+# JSON bodies are serialized with orjson rather than the stdlib encoder
+app = FastAPI(
+    title="INSAT COG Explorer API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Configure CORS
+# Explicit origins (the Vite dev server by default; set INSAT_CORS_ORIGINS to a
+# comma separated list in production) and a day-long max_age so browsers
+# cache preflight responses instead of repeating OPTIONS for every POST
+CORS_ORIGINS = os.environ.get(
+    "INSAT_CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173"
+).split(",")
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with your frontend URL
+    allow_origins=[origin.strip() for origin in CORS_ORIGINS if origin.strip()],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400,
 )
 
+log = logging.getLogger(__name__)
+
+def _stat_or_none(path):
+    """os.stat(path), or None when the file does not exist"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
 # Initialize our components
-h5_file_path = "../../data/Sample.h5"
+# Prefer the copy repacked by scripts/repack_h5.py (one chunk per band frame)
+h5_file_path = "../../data/Sample_opt.h5"
+if _stat_or_none(h5_file_path) is None:
+    h5_file_path = "../../data/Sample.h5"
 converter = INSATCOGConverter(h5_file_path)
 visualizer = INSATVisualizer()
 manipulator = INSATBandManipulator()
 
+# Output directories that /api/files may serve from, resolved once
+FILE_ROOTS = {
+    name: os.path.realpath(os.path.join("../../output", name))
+    for name in ("converted_cogs", "visualizations", "manipulations")
+}
+
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+}
+
+def _etag(st):
+    """Strong validator built from a file's mtime and size"""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+def _cache_headers(st):
+    """
+    Cache-Control plus the ETag/Last-Modified validators for a stat result
+    
+    Visualizations and band products are regenerated in place under the
+    same URL, so clients may keep a copy but must revalidate it on every
+    use (a cheap 304 while unchanged) rather than trust it for a fixed time.
+    """
+    return {
+        "Cache-Control": "no-cache",
+        "ETag": _etag(st),
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True)
+    }
+
+def _not_modified(request, st):
+    """True when the request's validators show the client already has this version"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or _etag(st) in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _file_response(request, path, st):
+    """
+    FileResponse with the media type, stat result and cache headers
+    precomputed, or a bodiless 304 when the client's copy is current
+    """
+    headers = _cache_headers(st)
+    if _not_modified(request, st):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(
+        path,
+        media_type=MEDIA_TYPES.get(os.path.splitext(path)[1].lower()),
+        stat_result=st,
+        headers=headers
+    )
+
+class BatchConvertRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    bands: list[str]
+
+class RGBRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    red: str
+    green: str
+    blue: str
+
+class BinaryOpRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    band1: str
+    band2: str
+
+class RatioRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    numerator: str
+    denominator: str
+
+# Rendered single band PNGs, most recently used last
+PNG_CACHE_SIZE = 32
+_png_cache = OrderedDict()
+_png_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def _bands_payload():
+    """Build the /api/bands response once; band metadata is static for a file"""
+    band_info = converter.get_band_info()
+    return {
+        "status": "success",
+        "data": {
+            name: {
+                "description": info["description"],
+                "wavelength": info["wavelength"],
+                "dimensions": "1616×1737"  # You might want to get this dynamically
+            }
+            for name, info in band_info.items()
+        }
+    }
+
+_h5_lock = threading.Lock()
+
+def _h5_handle(mtime_ns=None):
+    """
+    The shared HDF5 handle, reopened first if the file's mtime_ns (stat'ed
+    when not given) differs from the version it was opened at
+    
+    The replaced handle is not closed here since another request may still
+    be reading from it; h5py closes it once the last reference is dropped.
+    """
+    if mtime_ns is None:
+        mtime_ns = os.stat(h5_file_path).st_mtime_ns
+    with _h5_lock:
+        if app.state.h5_mtime_ns != mtime_ns:
+            app.state.h5 = open_h5(h5_file_path)
+            app.state.h5_mtime_ns = mtime_ns
+        return app.state.h5
+
+@lru_cache(maxsize=32)
+def _cog_path(band_name, h5_mtime_ns):
+    """
+    Convert a band and remember the COG path per HDF5 version (h5_mtime_ns),
+    so a changed source file misses the cache and is converted again
+    """
+    # A new h5_mtime_ns means the file changed, so read it through a fresh handle
+    output_path = converter.convert_band_to_cog(band_name, h5_handle=_h5_handle(h5_mtime_ns))
+    if not output_path:
+        # Raised rather than returned so a failure is not cached
+        raise FileNotFoundError(f"Conversion of {band_name} produced no COG")
+    
+    # A new COG may have appeared; drop the cached listings
+    visualizer.invalidate_cogs()
+    manipulator.invalidate_cogs()
+    return output_path
+
+@lru_cache(maxsize=32)
+def _manipulation_path(op, band1, band2, mtime1_ns, mtime2_ns):
+    """
+    Run a manipulator operation and remember its output path per version of
+    both input COGs, so reconverting either band recomputes the result
+    """
+    output_path = getattr(manipulator, op)(band1, band2)
+    if not output_path:
+        raise FileNotFoundError(f"{op} of {band1} and {band2} produced no output")
+    return output_path
+
+def _cached_path(func, *key):
+    """
+    Call one of the path caches above, redoing the work for this key only
+    if the cached file has since been removed from disk
+    
+    The path for a key never changes, so the cached entry stays valid once
+    the file has been written again; other keys' entries are untouched.
+    """
+    path = func(*key)
+    if _stat_or_none(path) is None:
+        path = func.__wrapped__(*key)
+    return path
+
+def _cog_mtime_ns(band_name):
+    """mtime_ns of a band's COG, or None when it has not been converted"""
+    st = _stat_or_none(manipulator.cogs.get(band_name, ""))
+    return st.st_mtime_ns if st else None
+
 @app.get("/api/bands")
 async def get_bands():
     """Get available spectral bands information"""
     try:
-        band_info = converter.get_band_info()
+        return await run_in_threadpool(_bands_payload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Declared before /api/convert/{band_name} so "batch" is not taken as a band name
+@app.post("/api/convert/batch")
+async def convert_bands(request: BatchConvertRequest):
+    """Convert several bands in one pass over the HDF5 file"""
+    try:
+        h5 = await run_in_threadpool(_h5_handle)
+        converted = await run_in_threadpool(
+            converter.convert_bands_to_cog, request.bands, h5_handle=h5
+        )
+        
+        # New COGs may have appeared; drop the cached listings
+        visualizer.invalidate_cogs()
+        manipulator.invalidate_cogs()
+        
         return {
             "status": "success",
             "data": {
-                name: {
-                    "description": info["description"],
-                    "wavelength": info["wavelength"],
-                    "dimensions": "1616×1737"  # You might want to get this dynamically
-                }
-                for name, info in band_info.items()
+                "files": converted,
+                "message": f"Converted {len(converted)} of {len(request.bands)} bands to COG format"
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
+        log.error("Batch conversion failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/convert/{band_name}")
 async def convert_band(band_name: str):
     """Convert a specific band to COG format"""
     try:
-        # Print debugging information
-        print(f"Converting band: {band_name}")
-        print(f"H5 file path: {converter.h5_file_path}")
-        print(f"Output directory: {converter.output_dir}")
-        print(f"Output directory exists: {os.path.exists(converter.output_dir)}")
+        log.debug("Converting band %s from %s into %s", band_name,
+                  converter.h5_file_path, converter.output_dir)
         
-        result = converter.convert_band_to_cog(band_name)
-        
-        print(f"Conversion result: {result}")
-        print(f"File exists: {os.path.exists(result) if result else False}")
+        # Repeat requests for an unchanged HDF5 file are a cache lookup
+        result = await run_in_threadpool(
+            _cached_path, _cog_path, band_name, os.stat(h5_file_path).st_mtime_ns
+        )
         
-        # Check if the COG file is in the output directory
-        expected_cog_file = os.path.join(converter.output_dir, f"{band_name}_cog.tif")
-        print(f"Expected COG file: {expected_cog_file}")
-        print(f"Expected file exists: {os.path.exists(expected_cog_file)}")
+        # The stat() only runs when debug logging is enabled
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Conversion result: %s (exists: %s)",
+                      result, _stat_or_none(result) is not None)
         
         return {
             "status": "success",
@@ -77,51 +306,99 @@ async def convert_band(band_name: str):
                 "message": f"Successfully converted {band_name} to COG format"
             }
         }
+    except HTTPException:
+        raise
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        print(f"ERROR in conversion: {str(e)}")
+        log.error("Conversion of %s failed: %s", band_name, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/visualize/{band_name}")
-async def visualize_band(band_name: str):
+async def visualize_band(band_name: str, request: Request):
     """Get visualization for a specific band"""
     try:
-        output_path = visualizer.visualize_single_band(band_name)
-        if output_path and os.path.exists(output_path):
-            return FileResponse(output_path)
-        raise HTTPException(status_code=404, detail="Visualization not found")
+        # The PNG is derived from the COG, so the COG's validators stand in
+        # for it and a client with a current copy skips the render entirely
+        st = _stat_or_none(visualizer.cogs.get(band_name, ""))
+        if st is None:
+            raise HTTPException(status_code=404, detail="Visualization not found")
+        headers = _cache_headers(st)
+        if _not_modified(request, st):
+            return Response(status_code=304, headers=headers)
+        
+        # Keyed by the COG version so a reconverted band is re-rendered
+        key = (band_name, st.st_mtime_ns)
+        with _png_cache_lock:
+            content = _png_cache.get(key)
+            if content is not None:
+                _png_cache.move_to_end(key)
+        
+        if content is None:
+            content = await run_in_threadpool(visualizer.render_single_band_bytes, band_name)
+            if content is None:
+                raise HTTPException(status_code=404, detail="Visualization not found")
+            with _png_cache_lock:
+                _png_cache[key] = content
+                while len(_png_cache) > PNG_CACHE_SIZE:
+                    _png_cache.popitem(last=False)
+        
+        return Response(content=content, media_type="image/png", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/visualize/rgb")
-async def create_rgb_composite(bands: dict):
+async def create_rgb_composite(bands: RGBRequest, request: Request):
     """Create RGB composite from selected bands"""
     try:
-        output_path = visualizer.create_rgb_composite(
-            bands["red"], bands["green"], bands["blue"]
+        # Make sure all three COGs exist, converting any missing ones together
+        band_names = [bands.red, bands.green, bands.blue]
+        if not all(converter.is_converted(band) for band in band_names):
+            h5 = await run_in_threadpool(_h5_handle)
+            await run_in_threadpool(
+                converter.convert_bands_to_cog, band_names, h5_handle=h5
+            )
+            visualizer.invalidate_cogs()
+            manipulator.invalidate_cogs()
+        
+        output_path = await run_in_threadpool(
+            visualizer.create_rgb_composite,
+            bands.red, bands.green, bands.blue
         )
-        if output_path and os.path.exists(output_path):
-            return FileResponse(output_path)
+        st = _stat_or_none(output_path) if output_path else None
+        if st is not None:
+            return _file_response(request, output_path, st)
         raise HTTPException(status_code=404, detail="RGB composite not found")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/manipulate/difference")
-async def calculate_difference(bands: dict):
+async def calculate_difference(bands: BinaryOpRequest):
     """Calculate difference between two bands"""
     try:
-        # Print debugging info
-        print(f"Calculating difference for bands: {bands}")
-        print(f"Available COGs: {manipulator.get_available_cogs()}")
+        log.debug("Calculating difference for bands: %s (available COGs: %s)",
+                  bands, manipulator.cogs)
         
-        output_path = manipulator.band_difference(bands["band1"], bands["band2"])
+        mtimes = (_cog_mtime_ns(bands.band1), _cog_mtime_ns(bands.band2))
+        if None in mtimes:
+            raise HTTPException(status_code=404, detail="Band data not found")
         
-        print(f"Output path: {output_path}")
-        print(f"Output file exists: {os.path.exists(output_path) if output_path else False}")
+        output_path = await run_in_threadpool(
+            _cached_path, _manipulation_path, "band_difference", bands.band1, bands.band2, *mtimes
+        )
+        
+        log.debug("Output path: %s", output_path)
         
-        if output_path and os.path.exists(output_path):
+        # _cached_path has already checked that output_path exists
+        if output_path:
             vis_path = f"{os.path.splitext(output_path)[0]}_vis.png"
-            print(f"Visualization path: {vis_path}")
-            print(f"Visualization exists: {os.path.exists(vis_path)}")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Visualization path: %s (exists: %s)",
+                          vis_path, _stat_or_none(vis_path) is not None)
             
             return {
                 "status": "success",
@@ -131,29 +408,37 @@ async def calculate_difference(bands: dict):
                 }
             }
         raise HTTPException(status_code=404, detail="Result not found")
+    except HTTPException:
+        raise
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Result not found")
     except Exception as e:
-        print(f"ERROR in difference calculation: {str(e)}")
+        log.error("Difference calculation failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/manipulate/ratio")
-async def calculate_ratio(bands: dict):
+async def calculate_ratio(bands: RatioRequest):
     """Calculate ratio between two bands"""
     try:
-        # Print debugging info
-        print(f"Calculating ratio for bands: {bands}")
-        print(f"Available COGs: {manipulator.get_available_cogs()}")
-        print(f"Output directory: {manipulator.output_directory}")
-        print(f"Output directory exists: {os.path.exists(manipulator.output_directory)}")
+        log.debug("Calculating ratio for bands: %s (available COGs: %s, output directory: %s)",
+                  bands, manipulator.cogs, manipulator.output_directory)
         
-        output_path = manipulator.band_ratio(bands["numerator"], bands["denominator"])
+        mtimes = (_cog_mtime_ns(bands.numerator), _cog_mtime_ns(bands.denominator))
+        if None in mtimes:
+            raise HTTPException(status_code=404, detail="Band data not found")
         
-        print(f"Output path: {output_path}")
-        print(f"Output file exists: {os.path.exists(output_path) if output_path else False}")
+        output_path = await run_in_threadpool(
+            _cached_path, _manipulation_path, "band_ratio", bands.numerator, bands.denominator, *mtimes
+        )
+        
+        log.debug("Output path: %s", output_path)
         
-        if output_path and os.path.exists(output_path):
+        # _cached_path has already checked that output_path exists
+        if output_path:
             vis_path = f"{os.path.splitext(output_path)[0]}_vis.png"
-            print(f"Visualization path: {vis_path}")
-            print(f"Visualization exists: {os.path.exists(vis_path)}")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Visualization path: %s (exists: %s)",
+                          vis_path, _stat_or_none(vis_path) is not None)
             
             return {
                 "status": "success",
@@ -163,40 +448,94 @@ async def calculate_ratio(bands: dict):
                 }
             }
         raise HTTPException(status_code=404, detail="Result not found")
+    except HTTPException:
+        raise
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Result not found")
     except Exception as e:
-        print(f"ERROR in ratio calculation: {str(e)}")
+        log.error("Ratio calculation failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/files/{directory}/{filename}")
-async def serve_file(directory: str, filename: str):
+async def serve_file(directory: str, filename: str, request: Request):
     """Serve files from output directories"""
-    base_path = Path("../../output")
-    file_path = base_path / directory / filename
-    if not file_path.exists():
+    root = FILE_ROOTS.get(directory)
+    if root is None:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(str(file_path))
+    
+    # realpath collapses any ".." so the containment check cannot be bypassed
+    file_path = os.path.realpath(os.path.join(root, filename))
+    st = _stat_or_none(file_path) if file_path.startswith(root + os.sep) else None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+    return _file_response(request, file_path, st)
+
+# Reusable read buffer for statistics; bands share a shape and dtype, so it
+# is allocated once rather than per request. Guarded by _stats_lock.
+_stats_buffer = None
+_stats_lock = threading.Lock()
+
+@lru_cache(maxsize=64)
+def _band_statistics(band_name, mtime_ns):
+    """
+    Statistics for a band's COG, computed in one fused pass and cached per
+    COG version (mtime_ns), so a reconverted band is recomputed
+    """
+    global _stats_buffer
+    cog_path = manipulator.cogs.get(band_name)
+    if cog_path is None:
+        return None
+    
+    with rasterio.open(cog_path) as src, _stats_lock:
+        if (_stats_buffer is None or _stats_buffer.shape != src.shape
+                or _stats_buffer.dtype != src.dtypes[0]):
+            _stats_buffer = np.empty(src.shape, dtype=src.dtypes[0])
+        src.read(1, out=_stats_buffer)
+        minimum, maximum, mean, std = band_stats_kernel(_stats_buffer)
+    
+    # The kernel returns Python floats, which serialize as they are
+    return {
+        "minimum": minimum,
+        "maximum": maximum,
+        "mean": mean,
+        "std": std
+    }
 
 @app.get("/api/statistics/{band_name}")
 async def get_band_statistics(band_name: str):
     """Get statistical information for a band"""
     try:
-        data, _ = manipulator.load_band_data(band_name)
-        if data is None:
+        mtime_ns = _cog_mtime_ns(band_name)
+        if mtime_ns is None:
+            raise HTTPException(status_code=404, detail="Band data not found")
+        
+        stats = await run_in_threadpool(_band_statistics, band_name, mtime_ns)
+        if stats is None:
             raise HTTPException(status_code=404, detail="Band data not found")
         
-        stats = {
-            "minimum": float(data.min()),
-            "maximum": float(data.max()),
-            "mean": float(data.mean()),
-            "std": float(data.std())
-        }
         return {
             "status": "success",
             "data": stats
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # One worker by default: the COG listings, manifest, path and statistics
+    # caches live in process memory and a conversion only invalidates those
+    # of the worker that ran it, so with several workers the others keep
+    # serving stale listings. INSAT_API_WORKERS raises it for read-only use.
+    # "auto" picks uvloop/httptools where uvicorn[standard] installed them
+    # and falls back to asyncio/h11 elsewhere (uvloop has no Windows build).
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get("INSAT_API_WORKERS", 1)),
+        loop="auto",
+        http="auto",
+        log_level="info"
+    ) 
\ No newline at end of file